@@ -5,9 +5,10 @@ Modelica AST definitions
 from __future__ import print_function, absolute_import, division, print_function, unicode_literals
 
 import copy
+import itertools
 import json
 from enum import Enum
-from typing import List, Union, Dict
+from typing import Callable, List, Optional, Union, Dict, Tuple
 from collections import OrderedDict
 
 
@@ -65,15 +66,55 @@ Root Class
 """
 
 
+_node_fields = {}  # type: Dict[type, Tuple[str, ...]]
+
+# Types that do not have to be copied when deep copying nodes
+_atomic_types = {type(None), bool, int, float, str}
+
+
 class Node:
+    # Nodes store their fields in slots instead of a per-instance __dict__,
+    # which considerably reduces the memory footprint of large trees.
+    # Subclasses declare their fields in __slots__, in the same order as
+    # they are initialized.
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         self.set_args(**kwargs)
 
+    @classmethod
+    def fields(cls) -> Tuple[str, ...]:
+        """
+        The names of the fields of this node type, in order of definition.
+        """
+        try:
+            return _node_fields[cls]
+        except KeyError:
+            fields = tuple(key for c in reversed(cls.__mro__) for key in c.__dict__.get('__slots__', ()))
+            _node_fields[cls] = fields
+            return fields
+
     def set_args(self, **kwargs):
+        fields = self.fields()
         for key in kwargs.keys():
-            if key not in self.__dict__.keys():
+            if key not in fields:
                 raise KeyError('{:s} not valid arg'.format(key))
-            self.__dict__[key] = kwargs[key]
+            setattr(self, key, kwargs[key])
+
+    def __deepcopy__(self, memo):
+        return self._deepcopy(memo)
+
+    def _deepcopy(self, memo, shallow=()):
+        # Deep copy of all fields, except those in shallow which are shared
+        # with the copy.
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        for key in self.fields():
+            value = getattr(self, key)
+            if key not in shallow and type(value) not in _atomic_types:
+                value = copy.deepcopy(value, memo)
+            setattr(new, key, value)
+        return new
 
     def __repr__(self):
         d = self.to_json(self)
@@ -89,8 +130,8 @@ class Node:
         elif isinstance(var, Node):
             # Avoid infinite recursion by not handling attributes that may go
             # back up in the tree again.
-            res = {key: cls.to_json(var.__dict__[key]) for key in var.__dict__.keys()
-                   if key not in ('parent', 'scope', '__deepcopy__')}
+            res = {key: cls.to_json(getattr(var, key)) for key in var.fields()
+                   if key not in ('parent', 'scope', 'class_loader')}
         elif isinstance(var, Visibility):
             res = str(var)
         else:
@@ -100,16 +141,52 @@ class Node:
     __str__ = __repr__
 
 
+_shared_primaries = {}  # type: Dict[int, str]
+
+
 class Primary(Node):
+    __slots__ = ('value',)
+
     def __init__(self, **kwargs):
         self.value = None  # type: Union[bool, float, int, str, type(None)]
         super().__init__(**kwargs)
 
+    def __setattr__(self, key, value):
+        if id(self) in _shared_primaries:
+            raise AttributeError("Shared default {} cannot be modified".format(self))
+        super().__setattr__(key, value)
+
+    def __deepcopy__(self, memo):
+        if id(self) in _shared_primaries:
+            return self
+        return self._deepcopy(memo)
+
+    def __reduce_ex__(self, protocol):
+        # Shared defaults are neither copied, nor duplicated when pickling.
+        try:
+            return _shared_primaries[id(self)]
+        except KeyError:
+            return super().__reduce_ex__(protocol)
+
     def __str__(self):
         return '{} value {}'.format(type(self).__name__, self.value)
 
 
+def _shared_primary(name: str, value) -> Primary:
+    p = Primary(value=value)
+    _shared_primaries[id(p)] = name
+    return p
+
+
+# Immutable defaults for unset attributes, shared by all nodes
+PRIMARY_NONE = _shared_primary('PRIMARY_NONE', None)
+PRIMARY_FALSE = _shared_primary('PRIMARY_FALSE', False)
+PRIMARY_EMPTY_STRING = _shared_primary('PRIMARY_EMPTY_STRING', "")
+
+
 class Array(Node):
+    __slots__ = ('values',)
+
     def __init__(self, **kwargs):
         self.values = []  # type: List[Union[Expression, Primary, ComponentRef, Array]]
         super().__init__(**kwargs)
@@ -119,9 +196,11 @@ class Array(Node):
 
 
 class Slice(Node):
+    __slots__ = ('start', 'stop', 'step')
+
     def __init__(self, **kwargs):
-        self.start = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef]
-        self.stop = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef]
+        self.start = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef]
+        self.stop = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef]
         self.step = Primary(value=1)  # type: Union[Expression, Primary, ComponentRef]
         super().__init__(**kwargs)
 
@@ -131,6 +210,8 @@ class Slice(Node):
 
 
 class ComponentRef(Node):
+    __slots__ = ('name', 'indices', 'child')
+
     def __init__(self, **kwargs):
         self.name = ''  # type: str
         self.indices = [[None]]  # type: List[List[Union[Expression, Slice, Primary, ComponentRef]]]
@@ -200,6 +281,8 @@ class ComponentRef(Node):
 
 
 class Expression(Node):
+    __slots__ = ('operator', 'operands')
+
     def __init__(self, **kwargs):
         self.operator = None  # type: Union[str, ComponentRef]
         self.operands = []  # type: List[Union[Expression, Primary, ComponentRef, Array, IfExpression]]
@@ -207,6 +290,8 @@ class Expression(Node):
 
 
 class IfExpression(Node):
+    __slots__ = ('conditions', 'expressions')
+
     def __init__(self, **kwargs):
         self.conditions = []  # type: List[Union[Expression, Primary, ComponentRef, Array, IfExpression]]
         self.expressions = []  # type: List[Union[Expression, Primary, ComponentRef, Array, IfExpression]]
@@ -214,6 +299,8 @@ class IfExpression(Node):
 
 
 class Constraint(Node):
+    __slots__ = ('left', 'right', 'comment', 'operand')
+
     def __init__(self, **kwargs):
         self.left = None  # type: Union[Expression, Primary, ComponentRef, List[Union[Expression, Primary, ComponentRef]]]
         self.right = None  # type: Union[Expression, Primary, ComponentRef, List[Union[Expression, Primary, ComponentRef]]]
@@ -223,6 +310,8 @@ class Constraint(Node):
 
 
 class Equation(Node):
+    __slots__ = ('left', 'right', 'comment')
+
     def __init__(self, **kwargs):
         self.left = None  # type: Union[Expression, Primary, ComponentRef, List[Union[Expression, Primary, ComponentRef]]]
         self.right = None  # type: Union[Expression, Primary, ComponentRef, List[Union[Expression, Primary, ComponentRef]]]
@@ -231,6 +320,8 @@ class Equation(Node):
 
 
 class IfEquation(Node):
+    __slots__ = ('conditions', 'blocks', 'comment')
+
     def __init__(self, **kwargs):
         self.conditions = []  # type: List[Union[Expression, Primary, ComponentRef]]
         self.blocks = []  # type: List[List[Union[Expression, ForEquation, ConnectClause, IfEquation]]]
@@ -239,6 +330,8 @@ class IfEquation(Node):
 
 
 class WhenEquation(Node):
+    __slots__ = ('conditions', 'blocks', 'comment')
+
     def __init__(self, **kwargs):
         self.conditions = []  # type: List[Union[Expression, Primary, ComponentRef]]
         self.blocks = []  # type: List[List[Union[Expression, ForEquation, ConnectClause, IfEquation]]]
@@ -247,6 +340,8 @@ class WhenEquation(Node):
 
 
 class ForIndex(Node):
+    __slots__ = ('name', 'expression')
+
     def __init__(self, **kwargs):
         self.name = ''  # type: str
         self.expression = None  # type: Union[Expression, Primary, Slice]
@@ -254,6 +349,8 @@ class ForIndex(Node):
 
 
 class ForEquation(Node):
+    __slots__ = ('indices', 'equations', 'comment')
+
     def __init__(self, **kwargs):
         self.indices = []  # type: List[ForIndex]
         self.equations = []  # type: List[Union[Equation, ForEquation, ConnectClause]]
@@ -262,14 +359,20 @@ class ForEquation(Node):
 
 
 class ConnectClause(Node):
+    __slots__ = ('left', 'right', 'comment', 'left_inner', 'right_inner')
+
     def __init__(self, **kwargs):
         self.left = ComponentRef()  # type: ComponentRef
         self.right = ComponentRef()  # type: ComponentRef
         self.comment = ''  # type: str
+        self.left_inner = None  # type: bool
+        self.right_inner = None  # type: bool
         super().__init__(**kwargs)
 
 
 class AssignmentStatement(Node):
+    __slots__ = ('left', 'right', 'comment')
+
     def __init__(self, **kwargs):
         self.left = []  # type: List[ComponentRef]
         self.right = None  # type: Union[Expression, IfExpression, Primary, ComponentRef]
@@ -278,6 +381,8 @@ class AssignmentStatement(Node):
 
 
 class IfStatement(Node):
+    __slots__ = ('conditions', 'blocks', 'comment')
+
     def __init__(self, **kwargs):
         self.conditions = []  # type: List[Union[Expression, Primary, ComponentRef]]
         self.blocks = []  # type: List[List[Union[AssignmentStatement, IfStatement, ForStatement]]]
@@ -286,6 +391,8 @@ class IfStatement(Node):
 
 
 class WhenStatement(Node):
+    __slots__ = ('conditions', 'blocks', 'comment')
+
     def __init__(self, **kwargs):
         self.conditions = []  # type: List[Union[Expression, Primary, ComponentRef]]
         self.blocks = []  # type: List[List[Union[AssignmentStatement, IfStatement, ForStatement]]]
@@ -294,6 +401,8 @@ class WhenStatement(Node):
 
 
 class ForStatement(Node):
+    __slots__ = ('indices', 'statements', 'comment')
+
     def __init__(self, **kwargs):
         self.indices = []  # type: List[ForIndex]
         self.statements = []  # type: List[Union[AssignmentStatement, IfStatement, ForStatement]]
@@ -302,6 +411,8 @@ class ForStatement(Node):
 
 
 class Function(Node):
+    __slots__ = ('name', 'arguments', 'comment')
+
     def __init__(self, **kwargs):
         self.name = '' # type: str
         self.arguments = []  # type: List[Union[Expression, Primary, ComponentRef, Array]]
@@ -315,6 +426,10 @@ class Symbol(Node):
     """
     ATTRIBUTES = ['value', 'min', 'max', 'start', 'fixed', 'nominal', 'unit', 'free', 'initialGuess']
 
+    __slots__ = ('name', 'type', 'prefixes', 'redeclare', 'final', 'inner', 'outer', 'dimensions', 'comment',
+                 'start', 'min', 'max', 'nominal', 'value', 'fixed', 'unit', 'free', 'initialGuess', 'id',
+                 'order', 'visibility', 'class_modification', 'connector_type')
+
     def __init__(self, **kwargs):
         self.name = ''  # type: str
         self.type = ComponentRef()  # type: Union[ComponentRef, InstanceClass]
@@ -323,21 +438,22 @@ class Symbol(Node):
         self.final = False  # type: bool
         self.inner = False  # type: bool
         self.outer = False  # type: bool
-        self.dimensions = [[Primary(value=None)]]  # type: List[List[Union[Expression, Primary, ComponentRef]]]
+        self.dimensions = [[PRIMARY_NONE]]  # type: List[List[Union[Expression, Primary, ComponentRef]]]
         self.comment = ''  # type: str
-        self.start = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef, Array]
-        self.min = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef, Array]
-        self.max = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef, Array]
-        self.nominal = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef, Array]
-        self.value = Primary(value=None)  # type: Union[Expression, Primary, ComponentRef, Array]
-        self.fixed = Primary(value=False)  # type: Primary
-        self.unit = Primary(value="")  # type: Primary
-        self.free = Primary(value=False) # type: Primary
-        self.initialGuess = Primary(value=None) # type: Union[Expression, Primary, ComponentRef, Array]
+        self.start = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef, Array]
+        self.min = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef, Array]
+        self.max = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef, Array]
+        self.nominal = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef, Array]
+        self.value = PRIMARY_NONE  # type: Union[Expression, Primary, ComponentRef, Array]
+        self.fixed = PRIMARY_FALSE  # type: Primary
+        self.unit = PRIMARY_EMPTY_STRING  # type: Primary
+        self.free = PRIMARY_FALSE # type: Primary
+        self.initialGuess = PRIMARY_NONE # type: Union[Expression, Primary, ComponentRef, Array]
         self.id = 0  # type: int
         self.order = 0  # type: int
         self.visibility = Visibility.PRIVATE  # type: Visibility
         self.class_modification = None  # type: ClassModification
+        self.connector_type = None  # type: Class
         super().__init__(**kwargs)
 
     def __str__(self):
@@ -345,16 +461,20 @@ class Symbol(Node):
 
 
 class ComponentClause(Node):
+    __slots__ = ('prefixes', 'type', 'dimensions', 'comment', 'symbol_list')
+
     def __init__(self, **kwargs):
         self.prefixes = []  # type: List[str]
         self.type = ComponentRef()  # type: ComponentRef
-        self.dimensions = [[Primary(value=None)]]  # type: List[List[Union[Expression, Primary, ComponentRef]]]
+        self.dimensions = [[PRIMARY_NONE]]  # type: List[List[Union[Expression, Primary, ComponentRef]]]
         self.comment = []  # type: List[str]
         self.symbol_list = []  # type: List[Symbol]
         super().__init__(**kwargs)
 
 
 class EquationSection(Node):
+    __slots__ = ('initial', 'equations')
+
     def __init__(self, **kwargs):
         self.initial = False  # type: bool
         self.equations = []  # type: List[Union[Equation, IfEquation, ForEquation, ConnectClause]]
@@ -362,6 +482,8 @@ class EquationSection(Node):
 
 
 class ConstraintSection(Node):
+    __slots__ = ('initial', 'constraints')
+
     def __init__(self, **kwargs):
         self.initial = False  # type: bool
         self.constraints = []  # type: List[Union[Constraint]]
@@ -369,6 +491,8 @@ class ConstraintSection(Node):
 
 
 class AlgorithmSection(Node):
+    __slots__ = ('initial', 'statements')
+
     def __init__(self, **kwargs):
         self.initial = False  # type: bool
         self.statements = []  # type: List[Union[AssignmentStatement, IfStatement, ForStatement]]
@@ -376,6 +500,8 @@ class AlgorithmSection(Node):
 
 
 class ImportAsClause(Node):
+    __slots__ = ('component', 'name')
+
     def __init__(self, **kwargs):
         self.component = ComponentRef()  # type: ComponentRef
         self.name = ''  # type: str
@@ -383,6 +509,8 @@ class ImportAsClause(Node):
 
 
 class ImportFromClause(Node):
+    __slots__ = ('component', 'symbols')
+
     def __init__(self, **kwargs):
         self.component = ComponentRef()  # type: ComponentRef
         self.symbols = []  # type: List[str]
@@ -390,6 +518,8 @@ class ImportFromClause(Node):
 
 
 class ElementModification(Node):
+    __slots__ = ('component', 'modifications')
+
     def __init__(self, **kwargs):
         self.component = ComponentRef()  # type: Union[ComponentRef]
         self.modifications = []  # type: List[Union[Primary, Expression, ClassModification, Array, ComponentRef]]
@@ -397,6 +527,8 @@ class ElementModification(Node):
 
 
 class ShortClassDefinition(Node):
+    __slots__ = ('name', 'type', 'component', 'class_modification')
+
     def __init__(self, **kwargs):
         self.name = ''  # type: str
         self.type = ''  # type: str
@@ -406,18 +538,24 @@ class ShortClassDefinition(Node):
 
 
 class ElementReplaceable(Node):
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         # TODO, add fields ?
         super().__init__(**kwargs)
 
 
 class ClassModification(Node):
+    __slots__ = ('arguments',)
+
     def __init__(self, **kwargs):
         self.arguments = []  # type: List[ClassModificationArgument]
         super().__init__(**kwargs)
 
 
 class ClassModificationArgument(Node):
+    __slots__ = ('value', 'scope', 'redeclare')
+
     def __init__(self, **kwargs):
         self.value = []  # type: Union[ElementModification, ComponentClause, ShortClassDefinition]
         self.scope = None  # type: InstanceClass
@@ -425,15 +563,12 @@ class ClassModificationArgument(Node):
         super().__init__(**kwargs)
 
     def __deepcopy__(self, memo):
-        _scope, _deepcp = self.scope, self.__deepcopy__
-        self.scope, self.__deepcopy__ = None, None
-        new = copy.deepcopy(self, memo)
-        self.scope, self.__deepcopy__ = _scope, _deepcp
-        new.scope, new.__deepcopy__ = _scope, _deepcp
-        return new
+        return self._deepcopy(memo, shallow=('scope',))
 
 
 class ExtendsClause(Node):
+    __slots__ = ('component', 'class_modification', 'visibility')
+
     def __init__(self, **kwargs):
         self.component = None  # type: ComponentRef
         self.class_modification = None  # type: ClassModification
@@ -442,6 +577,10 @@ class ExtendsClause(Node):
 
 
 class Class(Node):
+    __slots__ = ('name', 'imports', 'extends', 'encapsulated', 'partial', 'final', 'type', 'comment',
+                 'classes', 'symbols', 'functions', 'initial_equations', 'equations', 'constraints',
+                 'initial_statements', 'statements', 'annotation', 'optimization_attributes', 'parent')
+
     def __init__(self, **kwargs):
         self.name = None  # type: str
         self.imports = []  # type: List[Union[ImportAsClause, ImportFromClause]]
@@ -467,6 +606,9 @@ class Class(Node):
 
     def _find_class(self, component_ref: ComponentRef, search_parent=True) -> 'Class':
         try:
+            if component_ref.name not in self.classes:
+                self._load_class(component_ref.name)
+
             if not component_ref.child:
                 return self.classes[component_ref.name]
             else:
@@ -478,6 +620,25 @@ class Class(Node):
             else:
                 raise ClassNotFoundError("Could not find class '{}'".format(component_ref))
 
+    def _load_class(self, name: str) -> bool:
+        """
+        Ask the class loader of the root (if any) to load a nested class of
+        this class that has not been loaded yet.
+
+        :param name: Name of the nested class
+        :return: True if any classes were loaded, False otherwise
+        """
+        names = [name]
+        c = self
+        while c.parent is not None:
+            names.append(c.name)
+            c = c.parent
+
+        class_loader = getattr(c, 'class_loader', None)
+        if class_loader is None:
+            return False
+        return class_loader(tuple(reversed(names)))
+
     def find_class(self, component_ref: ComponentRef, copy=True, check_builtin_classes=False) -> 'Class':
         # TODO: Remove workaround for Modelica / Modelica.SIUnits
         if component_ref.name in ["Real", "Integer", "String", "Boolean", "Modelica", "SI"]:
@@ -555,12 +716,24 @@ class Class(Node):
         # Exclude the root node's name
         return ComponentRef.from_tuple(tuple(reversed(names[:-1])))
 
-    def _extend(self, other: 'Class') -> None:
-        for class_name in other.classes.keys():
-            if class_name in self.classes.keys():
-                self.classes[class_name]._extend(other.classes[class_name])
+    def _extend(self, other: 'Class', replace=False) -> List[Tuple[Optional['Class'], 'Class']]:
+        changed = []
+        for class_name, c in other.classes.items():
+            if class_name not in self.classes:
+                self.classes[class_name] = c
+                changed.append((None, c))
+            elif replace and c._has_contents():
+                changed.append((self.classes[class_name], c))
+                self.classes[class_name] = c
             else:
-                self.classes[class_name] = other.classes[class_name]
+                changed.extend(self.classes[class_name]._extend(c, replace))
+        return changed
+
+    def _has_contents(self) -> bool:
+        # Whether the class defines anything besides nested classes. Packages
+        # created for "within" clauses for example do not.
+        return bool(self.imports or self.extends or self.symbols or self.equations or self.initial_equations or
+                    self.constraints or self.statements or self.initial_statements)
 
     @property
     def root(self):
@@ -570,7 +743,20 @@ class Class(Node):
             return self.parent.root
 
     def copy_including_children(self):
-        return copy.deepcopy(self)
+        # Equations, constraints and statements are never modified in place
+        # when flattening, as they are copied anyway when their component
+        # references are flattened. They are therefore shared with the copy,
+        # such that only the nodes that may be modified are copied.
+        memo = {}
+        classes = [self]
+        while classes:
+            c = classes.pop()
+            for x in itertools.chain(c.equations, c.initial_equations, c.constraints,
+                                     c.statements, c.initial_statements):
+                memo[id(x)] = x
+            classes.extend(c.classes.values())
+            classes.extend(s.type for s in c.symbols.values() if isinstance(s.type, Class))
+        return copy.deepcopy(self, memo)
 
     def add_class(self, c: 'Class') -> None:
         """
@@ -624,15 +810,10 @@ class Class(Node):
 
     def __deepcopy__(self, memo):
         # Avoid copying the entire tree
-        if self.parent is not None and self.parent not in memo:
+        if self.parent is not None and id(self.parent) not in memo:
             memo[id(self.parent)] = self.parent
 
-        _deepcp = self.__deepcopy__
-        self.__deepcopy__ = None
-        new = copy.deepcopy(self, memo)
-        self.__deepcopy__ = _deepcp
-        new.__deepcopy__ = _deepcp
-        return new
+        return self._deepcopy(memo)
 
     def __str__(self):
         return '{} {}, Type "{}"'.format(type(self).__name__, self.name, self.type)
@@ -644,6 +825,8 @@ class InstanceClass(Class):
     symbols and extends clauses are shifted to the modification environment of
     this InstanceClass.
     """
+    __slots__ = ('modification_environment',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.modification_environment = ClassModification()
@@ -653,9 +836,29 @@ class Tree(Class):
     """
     The root class.
     """
-    def extend(self, other: 'Tree') -> None:
-        self._extend(other)
+    __slots__ = ('class_loader',)
+
+    def __init__(self, **kwargs):
+        # Optional callable that loads classes on demand. It is passed the
+        # tuple of names of the class to load, and returns whether anything
+        # was loaded.
+        self.class_loader = None  # type: Callable[[tuple], bool]
+        super().__init__(**kwargs)
+
+    def extend(self, other: 'Tree', replace=False) -> List[Tuple[Optional[Class], Class]]:
+        """
+        Add the classes of another tree to this tree. Classes that exist in
+        both trees are merged, or replaced by the class of the other tree if
+        replace is True. Classes without any contents of their own besides
+        nested classes are always merged.
+
+        :param other: Tree to add the classes of.
+        :param replace: Replace existing classes instead of merging them.
+        :return: List of (old, new) pairs of the classes that were added or replaced. Old is None for added classes.
+        """
+        changed = self._extend(other, replace)
         self.update_parent_refs()
+        return changed
 
     def _update_parent_refs(self, parent: Class) -> None:
         for c in parent.classes.values():
@@ -8,11 +8,25 @@ def _get_default_options():
     """
     return {
         'library_folders': [],
+        'parse_cache_folder': None,
+        'parse_workers': 1,
+        'lazy_loading': False,
+        'build_parse_tree': True,
         'verbose': False,
         'check_balanced': True,
         'mtime_check': True,
+        'hash_check': False,
         'cache': False,
+        'cache_folder': None,
+        'cache_size_limit': None,
+        'columnar_cache': False,
         'codegen': False,
+        'codegen_workers': None,
+        'codegen_split': False,
+        'codegen_single_library': False,
+        'codegen_derivatives': ['forward', 'reverse', 'hessian'],
+        'codegen_optimization_level': 2,
+        'codegen_extra_flags': [],
         'expand_mx': False,
         'unroll_loops': True,
         'inline_functions': True,
@@ -25,7 +39,11 @@ def _get_default_options():
         'eliminable_variable_expression': None,
         'factor_and_simplify_equations': False,
         'detect_aliases': False,
+        'incidence_alias_detection': False,
         'reduce_affine_expression': False,
+        'common_subexpression_elimination': False,
+        'simplification_report': False,
+        'simplification_report_file': None,
     }
 
 
@@ -13,11 +13,19 @@ class AliasRelation:
         # Construct aliases (a set of equivalent variables)
         aliases = self.aliases(a)
         inverted_aliases = self.aliases(self.__toggle_sign(a))
+        b_aliases = self.aliases(b)
 
-        aliases |= self.aliases(b)
+        # If a already has a set of aliases, only the aliases of b have to be
+        # moved over. This avoids quadratic behavior for long alias chains.
+        if a in self._aliases and b_aliases is not aliases and b_aliases is not inverted_aliases:
+            moved = b_aliases
+        else:
+            moved = None
+
+        aliases |= b_aliases
         inverted_aliases |= self.aliases(self.__toggle_sign(b))
 
-        for v in aliases:
+        for v in (aliases if moved is None else moved):
             self._aliases[self.__toggle_sign(v)] = inverted_aliases
             self._aliases[v] = aliases
 
@@ -29,7 +37,7 @@ class AliasRelation:
         self._canonical_variables.add(canonical_a)
         self._canonical_variables.discard(canonical_b)
 
-        for v in aliases:
+        for v in (aliases if moved is None else moved):
             self._canonical_variables_map[v] = (canonical_a, sign_a)
             self._canonical_variables_map[self.__toggle_sign(v)] = (canonical_a, -sign_a)
 
@@ -1,20 +1,28 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from enum import IntEnum
-from typing import Dict
+from typing import Dict, List, Tuple
 import casadi as ca
 import numpy as np
 import copy
 import sys
 import os
 import fnmatch
+import hashlib
 import logging
 import pickle
+import re
+import shutil
+import tempfile
+import time
+import uuid
 import contextlib
+import concurrent.futures
 
 from pymoca import __version__
+from pymoca.library import LibraryLoader
 from . import generator
 from .alias_relation import AliasRelation
-from .model import CASADI_ATTRIBUTES, Model, Variable, DelayArgument
+from .model import CASADI_ATTRIBUTES, Model, Variable, DelayArgument, _DefaultValue
 from ._options import _merge_default_options, _get_default_options as get_default_options
 
 logger = logging.getLogger("pymoca")
@@ -26,9 +34,64 @@ class _DepMeta(IntEnum):
     MX_INDEPENDENT = 2
 
 
+class _ColumnType(IntEnum):
+    FLOAT = 0
+    INT = 1
+    BOOL = 2
+    DEFAULT = 3
+    NONE = 4
+    OBJECT = 5
+    MX_DEPENDENT = 6
+    MX_INDEPENDENT = 7
+
+
+_COLUMN_TYPES = {float: _ColumnType.FLOAT, int: _ColumnType.INT, bool: _ColumnType.BOOL,
+                 _DefaultValue: _ColumnType.DEFAULT}
+
+_COLUMN_DECODERS = {
+    _ColumnType.FLOAT: float,
+    _ColumnType.INT: lambda x: int(x),
+    _ColumnType.BOOL: bool,
+    _ColumnType.DEFAULT: lambda x: _DefaultValue(int(x)),
+}
+
+_VARIABLE_CATEGORIES = ['states', 'der_states', 'alg_states', 'inputs', 'parameters', 'constants']
+
+# Categories in the output of the variable metadata function
+_METADATA_CATEGORIES = ['states', 'alg_states', 'inputs', 'parameters', 'constants']
+
+_COLUMNS = ['names', 'shapes', 'python_types', 'types', 'values']
+
+
+def _variables_property(key):
+    def getter(self):
+        if key not in self._variables:
+            self._materialize_variables(key)
+        return self._variables[key]
+
+    def setter(self, value):
+        self._variables[key] = value
+
+    return property(getter, setter)
+
+
 class CachedModel(Model):
 
+    states = _variables_property('states')
+    der_states = _variables_property('der_states')
+    alg_states = _variables_property('alg_states')
+    inputs = _variables_property('inputs')
+    parameters = _variables_property('parameters')
+    constants = _variables_property('constants')
+
     def __init__(self):
+        # Variables of a model loaded from a columnar cache are only created
+        # when they are first accessed.
+        self._variables = {}
+        self._columns = None
+        self._column_symbols = {}
+        self._column_metadata = {}
+
         self.states = []
         self.der_states = []
         self.alg_states = []
@@ -46,6 +109,8 @@ class CachedModel(Model):
         self._variable_metadata_function = None
         self._delay_arguments_function = None
 
+        self.simplification_report = None
+
     def __str__(self):
         r = ""
         r += "Model\n"
@@ -86,6 +151,65 @@ class CachedModel(Model):
     def simplify(self, options):
         raise NotImplementedError("Cannot simplify cached model")
 
+    def _symbols_of(self, key):
+        # The symbols of a category, without creating its variables
+        if key in self._variables or self._columns is None:
+            return self._symbols(getattr(self, key))
+        if key not in self._column_symbols:
+            columns = self._columns[key]
+            self._column_symbols[key] = [ca.MX.sym(str(name), *shape) for name, shape in
+                                         zip(columns['names'], columns['shapes'].tolist())]
+        return self._column_symbols[key]
+
+    def _metadata(self, dependent):
+        if dependent not in self._column_metadata:
+            if dependent:
+                parameter_vector = ca.veccat(*self._symbols_of('parameters'))
+                metadata = self.variable_metadata_function(parameter_vector)
+            else:
+                nan_vector = ca.veccat(*[np.nan for _ in self._symbols_of('parameters')])
+                metadata = (ca.MX(x) for x in self.variable_metadata_function(nan_vector))
+            self._column_metadata[dependent] = dict(zip(_METADATA_CATEGORIES, metadata))
+        return self._column_metadata[dependent]
+
+    def _materialize_variables(self, key):
+        columns = self._columns[key]
+        types = columns['types'].tolist()
+        values = columns['values'].tolist()
+        python_types = [self._python_types[i] for i in columns['python_types'].tolist()]
+
+        dependent = independent = None
+        if np.any(columns['types'] == _ColumnType.MX_DEPENDENT):
+            dependent = self._metadata(True)[key]
+        if np.any(columns['types'] == _ColumnType.MX_INDEPENDENT):
+            independent = self._metadata(False)[key]
+
+        variables = []
+        for i, symbol in enumerate(self._symbols_of(key)):
+            variable = Variable(symbol, python_types[i])
+
+            aliases = self._aliases.get(symbol.name())
+            if aliases is not None:
+                variable.aliases = aliases
+
+            for j, attr in enumerate(CASADI_ATTRIBUTES):
+                t = types[i][j]
+                if t in _COLUMN_DECODERS:
+                    value = _COLUMN_DECODERS[t](values[i][j])
+                elif t == _ColumnType.MX_DEPENDENT:
+                    value = dependent[i, j]
+                elif t == _ColumnType.MX_INDEPENDENT:
+                    value = independent[i, j]
+                elif t == _ColumnType.OBJECT:
+                    value = self._metadata_objects[(key, i, j)]
+                else:
+                    value = None
+                setattr(variable, attr, value)
+
+            variables.append(variable)
+
+        self._variables[key] = variables
+
 
 class InvalidCacheError(Exception):
     pass
@@ -97,17 +221,23 @@ def _compile_model(model_folder: str, model_name: str, compiler_options: Dict[st
     from pymoca import parser
 
     # Load folders
-    tree = None
-    for folder in [model_folder] + compiler_options['library_folders']:
-        for root, dir, files in os.walk(folder, followlinks=True):
-            for item in fnmatch.filter(files, "*.mo"):
-                logger.info("Parsing {}".format(item))
+    folders = [model_folder] + compiler_options['library_folders']
+    if compiler_options['lazy_loading']:
+        # Only index the files, and parse them when the classes they define
+        # are looked up during flattening.
+        loader = LibraryLoader.from_folders(folders, compiler_options['parse_cache_folder'],
+                                            compiler_options['parse_workers'],
+                                            compiler_options['build_parse_tree'])
+        tree = loader.create_tree()
+    else:
+        loader = None
+        file_names = _model_files(folders)
 
-                with open(os.path.join(root, item), 'r') as f:
-                    if tree is None:
-                        tree = parser.parse(f.read())
-                    else:
-                        tree.extend(parser.parse(f.read()))
+        logger.info("Parsing {} files".format(len(file_names)))
+
+        tree = parser.parse_files(file_names, compiler_options['parse_cache_folder'],
+                                  compiler_options['parse_workers'],
+                                  compiler_options['build_parse_tree'])
 
     # Compile
     logger.info("Generating CasADi model")
@@ -123,57 +253,225 @@ def _compile_model(model_folder: str, model_name: str, compiler_options: Dict[st
 
     model._post_checks()
 
-    return model
+    if loader is not None:
+        # Only the files that were actually needed
+        file_names = loader.loaded_files
 
-def _codegen_model(model_folder: str, f: ca.Function, library_name: str):
-    # Avoid locating compiler when loading from cache by loading
-    # distutils.ccompiler here on-demand.
-    import distutils.ccompiler
+    return model, file_names
 
-    # Compile shared libraries
+def _model_files(folders: List[str]) -> List[str]:
+    file_names = []
+    for folder in folders:
+        for root, dir, files in os.walk(folder, followlinks=True):
+            for item in fnmatch.filter(files, "*.mo"):
+                file_names.append(os.path.join(root, item))
+    return file_names
+
+def _cache_options(compiler_options: Dict[str, str]) -> Dict[str, str]:
+    # We ignore the library folders, as they have already been checked, and
+    # checking them will impede platform portability of the cache. The parse
+    # and codegen worker options only affect how fast the model is compiled,
+    # not the result. Neither do the options on how and where caches are
+    # stored and validated.
+    exclude_options = ['library_folders', 'parse_cache_folder', 'parse_workers', 'lazy_loading',
+                       'build_parse_tree', 'codegen_workers', 'codegen_split',
+                       'mtime_check', 'hash_check', 'cache_folder', 'cache_size_limit', 'columnar_cache',
+                       'simplification_report', 'simplification_report_file']
+    return {k: v for k, v in compiler_options.items() if k not in exclude_options}
+
+def _relative_dependencies(folders: List[str], file_names: List[str]) -> List[Tuple[int, str]]:
+    # Dependencies are stored relative to the folder they are in, such that
+    # the cache stays valid when the folders are moved or checked out
+    # elsewhere.
+    dependencies = []
+    for file_name in file_names:
+        for i, folder in enumerate(folders):
+            rel_path = os.path.relpath(file_name, folder)
+            if not rel_path.startswith(os.pardir):
+                dependencies.append((i, rel_path.replace(os.sep, '/')))
+                break
+        else:
+            raise ValueError("File '{}' is not in any of the model and library folders".format(file_name))
+    return sorted(dependencies)
+
+# Files modified less than this many seconds before they were hashed may be
+# modified again without their modification time changing. Their stats are
+# not trusted, such that they are always hashed again.
+_RACY_MTIME = 2.0
+
+def _dependency_hash(folders: List[str], dependencies: List[Tuple[int, str]],
+                     compiler_options: Dict[str, str], file_hashes: Dict[str, bytes] = None,
+                     file_stats: Dict[Tuple[int, str], Tuple[int, int, bytes]] = None) -> str:
+    # Files are only read again if their size or modification time differs
+    # from the one in file_stats, which is updated with the current stats.
+    if file_hashes is None:
+        file_hashes = {}
+    if file_stats is None:
+        file_stats = {}
+
+    h = hashlib.sha256()
+    h.update(repr(sorted(_cache_options(compiler_options).items())).encode('utf-8'))
+    for i, rel_path in dependencies:
+        file_name = os.path.join(folders[i], *rel_path.split('/'))
+        st = os.stat(file_name)
+        if file_name not in file_hashes:
+            size, mtime_ns, sha = file_stats.get((i, rel_path), (None, None, None))
+            if (size, mtime_ns) == (st.st_size, st.st_mtime_ns):
+                file_hashes[file_name] = sha
+            else:
+                with open(file_name, 'rb') as f:
+                    file_hashes[file_name] = hashlib.sha256(f.read()).digest()
+        if time.time() - st.st_mtime < _RACY_MTIME:
+            file_stats[(i, rel_path)] = (st.st_size, None, file_hashes[file_name])
+        else:
+            file_stats[(i, rel_path)] = (st.st_size, st.st_mtime_ns, file_hashes[file_name])
+        h.update(repr((i, rel_path)).encode('utf-8'))
+        h.update(file_hashes[file_name])
+    return h.hexdigest()
+
+_CODEGEN_DERIVATIVES = OrderedDict([
+    ('forward', lambda f: f.forward(1)),  # Jacobian-times-vector product
+    ('reverse', lambda f: f.reverse(1)),  # vector-times-Jacobian product
+    ('hessian', lambda f: f.reverse(1).forward(1)),  # Hessian-times-vector product
+    ('jacobian', lambda f: f.jacobian()),  # Full sparse Jacobian
+])
+
+# MSVC has no /O0 and /O3, and /O1 optimizes for size
+_MSVC_OPTIMIZATION_FLAGS = {0: '/Od', 1: '/O1', 2: '/O2', 3: '/O2'}
+
+def _compiler_flags(compiler_options: Dict[str, str]):
+    optimization_level = compiler_options['codegen_optimization_level']
+    if optimization_level not in _MSVC_OPTIMIZATION_FLAGS:
+        raise ValueError("Invalid codegen_optimization_level {}, expected 0, 1, 2 or 3".format(optimization_level))
     if os.name == 'posix':
-        compiler_flags = ['-O2', '-fPIC']
+        compiler_flags = ['-O{}'.format(optimization_level), '-fPIC']
         linker_flags = ['-fPIC']
     else:
-        compiler_flags = ['/O2', '/wd4101']  # Shut up unused local variable warnings.
+        compiler_flags = [_MSVC_OPTIMIZATION_FLAGS[optimization_level], '/wd4101']  # Shut up unused local variable warnings.
         linker_flags = ['/DLL']
+    compiler_flags.extend(compiler_options['codegen_extra_flags'])
+    return compiler_flags, linker_flags
 
+def _codegen_sources(model_folder: str, library_functions: List[ca.Function], library_name: str,
+                     compiler_options: Dict[str, str]) -> List[str]:
     # Generate C code
     logger.debug("Generating {}".format(library_name))
 
-    cg = ca.CodeGenerator(library_name)
-    cg.add(f, True) # Nondifferentiated function
-    cg.add(f.forward(1), True) # Jacobian-times-vector product
-    cg.add(f.reverse(1), True) # vector-times-Jacobian product
-    cg.add(f.reverse(1).forward(1), True) # Hessian-times-vector product
-    cg.generate(model_folder + '/')
+    derivatives = compiler_options['codegen_derivatives']
+    for d in derivatives:
+        if d not in _CODEGEN_DERIVATIVES:
+            raise ValueError("Unknown codegen derivative '{}', expected one of {}".format(
+                d, ', '.join(_CODEGEN_DERIVATIVES)))
+
+    # The Jacobian sparsity functions that are generated along with a
+    # function clash with the symbols of its generated Jacobian. The latter
+    # provides the sparsity as well.
+    with_jac_sparsity = 'jacobian' not in derivatives
+
+    functions = []
+    for f in library_functions:
+        functions.append((f, with_jac_sparsity))  # Nondifferentiated function
+        for d, derivative in _CODEGEN_DERIVATIVES.items():
+            if d in derivatives:
+                functions.append((derivative(f), True))
+
+    # The functions do not share any code, so they can be put in separate
+    # translation units that are compiled in parallel.
+    if compiler_options['codegen_split']:
+        units = [('{}_{}'.format(library_name, i), [g]) for i, g in enumerate(functions)]
+    else:
+        units = [(library_name, functions)]
+
+    file_names = []
+    for unit_name, unit_functions in units:
+        cg = ca.CodeGenerator(unit_name)
+        for g, g_with_jac_sparsity in unit_functions:
+            cg.add(g, g_with_jac_sparsity)
+        cg.generate(model_folder + '/')
+        file_names.append(os.path.relpath(os.path.join(model_folder, unit_name + '.c')))
+
+    return file_names
+
+def _compile_source(file_name: str, compiler_flags: List[str]) -> str:
+    # Avoid locating compiler when loading from cache by loading
+    # distutils.ccompiler here on-demand.
+    import distutils.ccompiler
 
     compiler = distutils.ccompiler.new_compiler()
 
-    file_name = os.path.relpath(os.path.join(model_folder, library_name + '.c'))
-    object_name = compiler.object_filenames([file_name])[0]
-    library = os.path.join(model_folder, library_name + compiler.shared_lib_extension)
+    # NOTE: For some reason running in debug mode in PyCharm (2017.1)
+    # on Windows causes cl.exe to fail on its own binary name (?!) and
+    # the include paths. This does not happen when running directly
+    # from cmd.exe / PowerShell or e.g. with debug mode in VS Code.
     try:
-        # NOTE: For some reason running in debug mode in PyCharm (2017.1)
-        # on Windows causes cl.exe to fail on its own binary name (?!) and
-        # the include paths. This does not happen when running directly
-        # from cmd.exe / PowerShell or e.g. with debug mode in VS Code.
-        compiler.compile([file_name], extra_postargs=compiler_flags)
+        return compiler.compile([file_name], extra_postargs=compiler_flags)[0]
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_name)
 
+def _link_library(model_folder: str, object_names: List[str], library_name: str, linker_flags: List[str]) -> str:
+    import distutils.ccompiler
+
+    compiler = distutils.ccompiler.new_compiler()
+
+    library = os.path.join(model_folder, library_name + compiler.shared_lib_extension)
+    try:
         # We do not want the "lib" prefix on POSIX systems, so we call
         # link() directly with our desired filename instead of
         # link_shared_lib().
-        compiler.link(compiler.SHARED_LIBRARY, [object_name], library, extra_preargs=linker_flags)
-    except:
-        raise
+        compiler.link(compiler.SHARED_LIBRARY, object_names, library, extra_preargs=linker_flags)
     finally:
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(file_name)
-            os.remove(object_name)
+        for object_name in object_names:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(object_name)
     return library
 
+def _codegen_model(model_folder: str, libraries: Dict[str, List[ca.Function]],
+                   compiler_options: Dict[str, str]) -> Dict[str, str]:
+    """
+    Generates and compiles a shared library for each set of functions.
+
+    :param model_folder: Folder where the shared libraries will be stored.
+    :param libraries: Dictionary of library name to the CasADi functions it should contain.
+    :param compiler_options: Dictionary of compiler options.
+
+    :returns: Dictionary of library name to path of the shared library.
+    """
+    workers = compiler_options['codegen_workers']
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    compiler_flags, linker_flags = _compiler_flags(compiler_options)
+
+    # Code generation is done sequentially, as CasADi is not thread safe.
+    # The compiler runs in a separate process, so we can run several of them
+    # from a pool of threads.
+    sources = OrderedDict()
+    try:
+        for library_name, functions in libraries.items():
+            sources[library_name] = _codegen_sources(model_folder, functions, library_name, compiler_options)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            objects = OrderedDict(
+                (library_name, [executor.submit(_compile_source, x, compiler_flags) for x in file_names])
+                for library_name, file_names in sources.items())
+
+            libraries = OrderedDict(
+                (library_name, executor.submit(_link_library, model_folder, [x.result() for x in futures],
+                                               library_name, linker_flags))
+                for library_name, futures in objects.items())
+
+            return OrderedDict((library_name, x.result()) for library_name, x in libraries.items())
+    finally:
+        # Clean up whatever was left behind by a failed compilation
+        for file_names in sources.values():
+            for file_name in file_names:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(file_name)
+
 def save_model(model_folder: str, model_name: str, model: Model,
-               compiler_options: Dict[str, str]) -> None:
+               compiler_options: Dict[str, str], dependency_files: List[str] = None,
+               cache_folder: str = None) -> None:
     """
     Saves a CasADi model to disk.
 
@@ -181,21 +479,39 @@ def save_model(model_folder: str, model_name: str, model: Model,
     :param model_name: Name of the model.
     :param model: Model instance.
     :param compiler_options: Dictionary of compiler options.
+    :param dependency_files: Modelica files the model was compiled from, used
+                             with the 'hash_check' option. Defaults to all files in the
+                             model and library folders.
+    :param cache_folder: Folder to store the model in instead of the model folder.
     """
 
     compiler_options = _merge_default_options(compiler_options)
 
+    if cache_folder is None:
+        cache_folder = model_folder
+
     objects = {'dae_residual': None, 'initial_residual': None, 'variable_metadata': None, 'delay_arguments': None}
     for o in objects.keys():
-        f = getattr(model, o + '_function')
+        objects[o] = getattr(model, o + '_function')
 
-        if compiler_options['codegen']:
-            objects[o] = _codegen_model(model_folder, f, '{}_{}'.format(model_name, o))
+    if compiler_options['codegen']:
+        if compiler_options['codegen_single_library']:
+            library_names = {o: model_name for o in objects.keys()}
         else:
-            objects[o] = f
+            library_names = {o: '{}_{}'.format(model_name, o) for o in objects.keys()}
+
+        libraries = OrderedDict()
+        for o, f in objects.items():
+            libraries.setdefault(library_names[o], []).append(f)
+
+        libraries = _codegen_model(cache_folder, libraries, compiler_options)
+        for o in objects.keys():
+            # Libraries are looked up next to the cache file, so that the
+            # cache can be moved.
+            objects[o] = os.path.basename(libraries[library_names[o]])
 
     # Output metadata
-    db_file = os.path.join(model_folder, model_name + ".pymoca_cache")
+    db_file = os.path.join(cache_folder, model_name + ".pymoca_cache")
     with open(db_file, 'wb') as f:
         db = {}
 
@@ -209,10 +525,19 @@ def save_model(model_folder: str, model_name: str, model: Model,
 
         db['options'] = compiler_options
 
-        # Describe variables per category
-        for key in ['states', 'der_states', 'alg_states', 'inputs', 'parameters', 'constants']:
-            db[key] = [e.to_dict() for e in getattr(model, key)]
+        if compiler_options['hash_check']:
+            folders = [model_folder] + compiler_options['library_folders']
+            if dependency_files is None:
+                dependency_files = _model_files(folders)
+            db['dependencies'] = _relative_dependencies(folders, dependency_files)
+            db['dependency_stats'] = {}
+            db['dependency_hash'] = _dependency_hash(folders, db['dependencies'], compiler_options,
+                                                     file_stats=db['dependency_stats'])
 
+        # Describe variables per category
+        if not compiler_options['columnar_cache']:
+            for key in _VARIABLE_CATEGORIES:
+                db[key] = [e.to_dict() for e in getattr(model, key)]
 
         # Caching using CasADi functions will lead to constants seemingly
         # depending on MX variables. Figuring out that they do not is slow,
@@ -238,7 +563,28 @@ def save_model(model_folder: str, model_name: str, model: Model,
                         else:
                             m[i, j] = _DepMeta.MX_INDEPENDENT
 
-        # Delay dependency checking
+        if compiler_options['columnar_cache']:
+            # Every save gets a folder of its own, such that loaders of the
+            # previous cache file never see a mix of old and new columns.
+            columns_folder = '{}.{}.pymoca_columns'.format(model_name, uuid.uuid4().hex)
+
+            # Written to a temporary folder first, such that loaders never
+            # see a partially written set of columns.
+            tmp_folder = tempfile.mkdtemp(dir=cache_folder, prefix='.tmp-')
+            try:
+                _save_columns(tmp_folder, model, db)
+                os.replace(tmp_folder, os.path.join(cache_folder, columns_folder))
+            except BaseException:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+                raise
+
+            db['columns'] = columns_folder
+
+        # Delay duration dependency checking. Durations often seemingly
+        # depend on all symbols of the model after a round trip through the
+        # delay arguments function. We therefore strip false dependencies
+        # once here, and store a function of only the actual dependencies.
+        # Loading then boils down to inlining a call to this function.
         if model.delay_states:
 
             all_symbols = [model.time,
@@ -250,13 +596,42 @@ def save_model(model_folder: str, model_name: str, model: Model,
                            *model._symbols(model.parameters)]
             symbol_to_index = {x: i for i, x in enumerate(all_symbols)}
 
-            expressions, durations = zip(*model.delay_arguments)
-
-            duration_dependencies = []
-            for dur in durations:
-                duration_dependencies.append(
-                    [symbol_to_index[var] for var in ca.symvar(dur) if ca.depends_on(dur, var)])
-            db['__delay_duration_dependent'] = duration_dependencies
+            dependent_durations = []
+            dependent_indices = []
+            independent_durations = {}
+            dependencies = set()
+            for i, delay_argument in enumerate(model.delay_arguments):
+                dur = ca.MX(delay_argument.duration)
+                symbols = ca.symvar(dur)
+                deps = [var for var in symbols if ca.depends_on(dur, var)]
+
+                if len(deps) < len(symbols):
+                    false_deps = [var for var in symbols if not ca.depends_on(dur, var)]
+                    [dur] = ca.substitute([dur], false_deps, [np.nan] * len(false_deps))
+
+                if deps:
+                    dependent_durations.append(dur)
+                    dependent_indices.append(i)
+                    dependencies.update(symbol_to_index[var] for var in deps)
+                else:
+                    independent_durations[i] = ca.evalf(ca.substitute(dur, ca.veccat(*symbols), np.nan))
+
+            dependencies = sorted(dependencies)
+            delay_durations_function = ca.Function('delay_durations', [all_symbols[j] for j in dependencies],
+                                                   dependent_durations, {'max_io': 0})
+            try:
+                # Pickling MX functions is only supported as of CasADi 3.5
+                delay_durations_function = delay_durations_function.expand()
+            except RuntimeError:
+                # Some calls, e.g. to external functions, cannot be expanded
+                logger.warning("Delay durations cannot be expanded to SX. Caching them requires CasADi >= 3.5.")
+
+            db['__delay_durations'] = {
+                'dependencies': dependencies,
+                'indices': dependent_indices,
+                'function': delay_durations_function,
+                'independent': independent_durations,
+            }
 
         db['outputs'] = model.outputs
 
@@ -266,22 +641,126 @@ def save_model(model_folder: str, model_name: str, model: Model,
 
         pickle.dump(db, f, protocol=-1)
 
-def load_model(model_folder: str, model_name: str, compiler_options: Dict[str, str]) -> CachedModel:
+    # Remove the columns of previous saves. Loads that memory-mapped them
+    # before may prevent this on some platforms.
+    columns_pattern = re.compile(re.escape(model_name) + r'\.[0-9a-f]{32}\.pymoca_columns')
+    for columns_folder in os.listdir(cache_folder):
+        if columns_pattern.fullmatch(columns_folder) and columns_folder != db.get('columns'):
+            shutil.rmtree(os.path.join(cache_folder, columns_folder), ignore_errors=True)
+
+def _save_columns(columns_folder: str, model: Model, db: Dict) -> None:
+    # Variables are stored as NumPy arrays, which can be memory-mapped when
+    # loading. Only the values that do not fit in these arrays are pickled.
+    python_types = db['python_types'] = []
+    aliases = db['aliases'] = {}
+    objects = db['metadata_objects'] = {}
+
+    for key in _VARIABLE_CATEGORIES:
+        variables = getattr(model, key)
+        dependent = db.pop(key + "__metadata_dependent", None)
+
+        n = len(variables)
+        columns = {
+            'names': np.array([v.symbol.name() for v in variables], dtype=str),
+            'shapes': np.array([v.symbol.shape for v in variables], dtype=int).reshape(n, 2),
+            'python_types': np.zeros(n, dtype=np.int16),
+            'types': np.zeros((n, len(CASADI_ATTRIBUTES)), dtype=np.int8),
+            'values': np.zeros((n, len(CASADI_ATTRIBUTES))),
+        }
+        types, values = columns['types'], columns['values']
+
+        for i, v in enumerate(variables):
+            if v.python_type not in python_types:
+                python_types.append(v.python_type)
+            columns['python_types'][i] = python_types.index(v.python_type)
+
+            if v.aliases:
+                aliases[v.symbol.name()] = v.aliases
+
+            for j, attr in enumerate(CASADI_ATTRIBUTES):
+                value = getattr(v, attr)
+                if isinstance(value, ca.MX):
+                    # Variables without metadata function store MX attributes as None
+                    if dependent is None:
+                        types[i, j] = _ColumnType.NONE
+                    elif dependent[i, j] == _DepMeta.MX_DEPENDENT:
+                        types[i, j] = _ColumnType.MX_DEPENDENT
+                    else:
+                        types[i, j] = _ColumnType.MX_INDEPENDENT
+                elif value is None:
+                    types[i, j] = _ColumnType.NONE
+                elif type(value) is float or (type(value) in _COLUMN_TYPES and float(value) == value):
+                    # Integers that do not fit in a float end up as objects
+                    types[i, j] = _COLUMN_TYPES[type(value)]
+                    values[i, j] = value
+                else:
+                    types[i, j] = _ColumnType.OBJECT
+                    objects[(key, i, j)] = value
+
+        for column in _COLUMNS:
+            np.save(os.path.join(columns_folder, '{}__{}.npy'.format(key, column)), columns[column])
+
+def _load_columns(columns_folder: str) -> Dict[str, Dict[str, np.ndarray]]:
+    return {key: {column: np.load(os.path.join(columns_folder, '{}__{}.npy'.format(key, column)), mmap_mode='r')
+                  for column in _COLUMNS}
+            for key in _VARIABLE_CATEGORIES}
+
+def _load_variables(model: CachedModel, db: Dict) -> None:
+    # Load variables per category
+    variable_dict = {}
+    for key in _METADATA_CATEGORIES:
+        variables = getattr(model, key)
+        for i, d in enumerate(db[key]):
+            variable = Variable.from_dict(d)
+            variables.append(variable)
+            variable_dict[variable.symbol.name()] = variable
+
+    model.der_states = [Variable.from_dict(d) for d in db['der_states']]
+
+    # Evaluate variable metadata:
+    parameter_vector = ca.veccat(*[v.symbol for v in model.parameters])
+    metadata = dict(zip(_METADATA_CATEGORIES, model.variable_metadata_function(parameter_vector)))
+    independent_metadata = dict(zip(
+        _METADATA_CATEGORIES,
+        (ca.MX(x) for x in model.variable_metadata_function(ca.veccat(*[np.nan for v in model.parameters])))))
+
+    for k, key in enumerate(_METADATA_CATEGORIES):
+        m = db[key + "__metadata_dependent"]
+        for i, d in enumerate(db[key]):
+            variable = variable_dict[d['name']]
+            for j, tmp in enumerate(CASADI_ATTRIBUTES):
+                if m[i, j] == _DepMeta.MX_DEPENDENT:
+                    setattr(variable, tmp, metadata[key][i, j])
+                elif m[i, j] == _DepMeta.MX_INDEPENDENT:
+                    setattr(variable, tmp, independent_metadata[key][i, j])
+                else:
+                    # Already handled as part of Variable dict. That way
+                    # we also do not have to worry about making sure the
+                    # type of the cached model is exactly the same, as
+                    # pickling ensures that.
+                    pass
+
+def load_model(model_folder: str, model_name: str, compiler_options: Dict[str, str],
+               cache_folder: str = None) -> CachedModel:
     """
     Loads a precompiled CasADi model into a CachedModel instance.
 
     :param model_folder: Folder where the precompiled CasADi model is located.
     :param model_name: Name of the model.
     :param compiler_options: Dictionary of compiler options.
+    :param cache_folder: Folder the model was stored in, if not the model folder.
 
     :returns: CachedModel instance.
     """
 
     compiler_options = _merge_default_options(compiler_options)
 
-    db_file = os.path.join(model_folder, model_name + ".pymoca_cache")
+    if cache_folder is None:
+        cache_folder = model_folder
 
-    if compiler_options['mtime_check']:
+    db_file = os.path.join(cache_folder, model_name + ".pymoca_cache")
+
+    if compiler_options['mtime_check'] and not compiler_options['hash_check']:
         # Mtime check
         cache_mtime = os.path.getmtime(db_file)
         for folder in [model_folder] + compiler_options['library_folders']:
@@ -307,26 +786,43 @@ def load_model(model_folder: str, model_name: str, compiler_options: Dict[str, s
         if db['version'] != __version__:
             raise InvalidCacheError('Cache generated for a different version of pymoca')
 
-        # Check compiler options. We ignore the library folders, as they have
-        # already been checked, and checking them will impede platform
-        # portability of the cache.
-        exclude_options = ['library_folders']
-        old_opts = {k: v for k, v in db['options'].items() if k not in exclude_options}
-        new_opts = {k: v for k, v in compiler_options.items() if k not in exclude_options}
-
-        if old_opts != new_opts:
+        # Check compiler options
+        if _cache_options(db['options']) != _cache_options(compiler_options):
             raise InvalidCacheError('Cache generated for different compiler options')
 
+        if compiler_options['hash_check']:
+            # Hash check of the files the model was compiled from
+            if 'dependency_hash' not in db:
+                raise InvalidCacheError("Cache generated without hash check")
+            folders = [model_folder] + compiler_options['library_folders']
+            dependency_stats = db['dependency_stats'].copy()
+            try:
+                # Only files whose size or modification time changed are read
+                dependency_hash = _dependency_hash(folders, db['dependencies'], compiler_options,
+                                                   file_stats=db['dependency_stats'])
+            except (FileNotFoundError, IndexError):
+                raise InvalidCacheError("Cache out of date")
+            if dependency_hash != db['dependency_hash']:
+                raise InvalidCacheError("Cache out of date")
+            update_stats = db['dependency_stats'] != dependency_stats
+        else:
+            update_stats = False
+
         # Pickles are platform independent, but dynamic libraries are not
         if compiler_options['codegen']:
             if db['library_os'] != os.name:
                 raise InvalidCacheError('Cache generated for incompatible OS')
 
-        # Include references to the shared libraries
+        # Include references to the shared libraries. Functions can share a
+        # library, which we then only open once.
+        importers = {}
         for o in ['dae_residual', 'initial_residual', 'variable_metadata', 'delay_arguments']:
             if isinstance(db[o], str):
                 # Path to codegen'd library
-                f = ca.external(o, db[o])
+                library = os.path.join(cache_folder, os.path.basename(db[o]))
+                if library not in importers:
+                    importers[library] = ca.Importer(library, 'dll')
+                f = ca.external(o, importers[library])
             else:
                 # Pickled CasADi Function; use as is
                 assert isinstance(db[o], ca.Function)
@@ -334,116 +830,74 @@ def load_model(model_folder: str, model_name: str, compiler_options: Dict[str, s
 
             setattr(model, '_' + o + '_function', f)
 
-        # Load variables per category
-        variables_with_metadata = ['states', 'alg_states', 'inputs', 'parameters', 'constants']
-        variable_dict = {}
-        for key in variables_with_metadata:
-            variables = getattr(model, key)
-            for i, d in enumerate(db[key]):
-                variable = Variable.from_dict(d)
-                variables.append(variable)
-                variable_dict[variable.symbol.name()] = variable
-
-        model.der_states = [Variable.from_dict(d) for d in db['der_states']]
         model.outputs = db['outputs']
         model.delay_states = db['delay_states']
         model.alias_relation = db['alias_relation']
 
-        # Evaluate variable metadata:
-        parameter_vector = ca.veccat(*[v.symbol for v in model.parameters])
-        metadata = dict(zip(variables_with_metadata, model.variable_metadata_function(parameter_vector)))
-        independent_metadata = dict(zip(
-            variables_with_metadata,
-            (ca.MX(x) for x in model.variable_metadata_function(ca.veccat(*[np.nan for v in model.parameters])))))
-
-        for k, key in enumerate(variables_with_metadata):
-            m = db[key + "__metadata_dependent"]
-            for i, d in enumerate(db[key]):
-                variable = variable_dict[d['name']]
-                for j, tmp in enumerate(CASADI_ATTRIBUTES):
-                    if m[i, j] == _DepMeta.MX_DEPENDENT:
-                        setattr(variable, tmp, metadata[key][i, j])
-                    elif m[i, j] == _DepMeta.MX_INDEPENDENT:
-                        setattr(variable, tmp, independent_metadata[key][i, j])
-                    else:
-                        # Already handled as part of Variable dict. That way
-                        # we also do not have to worry about making sure the
-                        # type of the cached model is exactly the same, as
-                        # pickling ensures that.
-                        pass
+        if 'columns' in db:
+            # Variables are created when they are accessed
+            model._columns = _load_columns(os.path.join(cache_folder, db['columns']))
+            model._python_types = db['python_types']
+            model._aliases = db['aliases']
+            model._metadata_objects = db['metadata_objects']
+            for key in _VARIABLE_CATEGORIES:
+                del model._variables[key]
+        else:
+            _load_variables(model, db)
 
         # Evaluate delay arguments:
         if model.delay_states:
             args = [model.time,
-                    ca.veccat(*model._symbols(model.states)),
-                    ca.veccat(*model._symbols(model.der_states)),
-                    ca.veccat(*model._symbols(model.alg_states)),
-                    ca.veccat(*model._symbols(model.inputs)),
-                    ca.veccat(*model._symbols(model.constants)),
-                    ca.veccat(*model._symbols(model.parameters))]
-            delay_arguments_raw = model.delay_arguments_function(*args)
-
-            nan_args = [ca.repmat(np.nan, *arg.size()) for arg in args]
-            independent_delay_arguments_raw = model.delay_arguments_function(*nan_args)
-
-            delay_expressions_raw = delay_arguments_raw[::2]
-            delay_durations_raw = delay_arguments_raw[1::2]
-            independent_delay_durations_raw = independent_delay_arguments_raw[1::2]
-
-            assert 1 == len({len(delay_expressions_raw), len(delay_durations_raw),
-                len(independent_delay_durations_raw)})
+                    ca.veccat(*model._symbols_of('states')),
+                    ca.veccat(*model._symbols_of('der_states')),
+                    ca.veccat(*model._symbols_of('alg_states')),
+                    ca.veccat(*model._symbols_of('inputs')),
+                    ca.veccat(*model._symbols_of('constants')),
+                    ca.veccat(*model._symbols_of('parameters'))]
+            delay_expressions = model.delay_arguments_function(*args)[::2]
 
             all_symbols = [model.time,
-                           *model._symbols(model.states),
-                           *model._symbols(model.der_states),
-                           *model._symbols(model.alg_states),
-                           *model._symbols(model.inputs),
-                           *model._symbols(model.constants),
-                           *model._symbols(model.parameters)]
-
-            duration_dependencies = db['__delay_duration_dependent']
-
-            # Get rid of false dependency symbols not used in any delay
-            # durations. This significantly reduces the work the (slow)
-            # substitute() calls have to do later on.
-            actual_deps = sorted(set(np.array(duration_dependencies).ravel()))
-
-            actual_dep_symbols = [np.nan] * len(all_symbols)
-            for i in actual_deps:
-                actual_dep_symbols[i] = all_symbols[i]
-
-            delay_durations_simplified = ca.Function(
-                'replace_false_deps',
-                all_symbols,
-                delay_durations_raw).call(
-                    actual_dep_symbols)
-
-            # Get rid of remaining hidden dependencies in the delay durations
-            for i, expr in enumerate(delay_expressions_raw):
-                if duration_dependencies[i]:
-                    dur = delay_durations_simplified[i]
-
-                    if len(duration_dependencies[i]) < len(actual_deps):
-                        deps = set(ca.symvar(dur))
-                        actual_deps = {all_symbols[j] for j in duration_dependencies[i]}
-                        false_deps = deps - actual_deps
-
-                        if false_deps:
-                            [dur] = ca.substitute(
-                                [dur],
-                                list(false_deps),
-                                [np.nan] * len(false_deps))
-                    else:
-                        # Already removed all false dependencies
-                        pass
-                else:
-                    dur = independent_delay_durations_raw[i]
-
-                model.delay_arguments.append(DelayArgument(expr, dur))
+                           *model._symbols_of('states'),
+                           *model._symbols_of('der_states'),
+                           *model._symbols_of('alg_states'),
+                           *model._symbols_of('inputs'),
+                           *model._symbols_of('constants'),
+                           *model._symbols_of('parameters')]
+
+            # The durations were stripped of false dependencies when saving
+            # the model. Inlining the call keeps it that way.
+            delay_durations = db['__delay_durations']
+            delay_durations_dependent = delay_durations['function'].call(
+                [all_symbols[j] for j in delay_durations['dependencies']], True, False)
+
+            durations = delay_durations['independent'].copy()
+            durations.update(zip(delay_durations['indices'], delay_durations_dependent))
+
+            for i, expr in enumerate(delay_expressions):
+                model.delay_arguments.append(DelayArgument(expr, durations[i]))
+
+    if update_stats:
+        # The files did not change, but their stats did (e.g. after a fresh
+        # checkout). Store the new stats, such that the next load does not
+        # have to read the files again.
+        _write_pickle(db_file, db)
 
     # Done
     return model
 
+def _write_pickle(file_name: str, obj) -> None:
+    # Written to a temporary file next to it first, such that concurrent
+    # readers never see a partially written file.
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=-1)
+        os.replace(tmp_file, file_name)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
 def transfer_model(model_folder: str, model_name: str, compiler_options=None):
 
     compiler_options = _merge_default_options(compiler_options)
@@ -465,15 +919,23 @@ def transfer_model(model_folder: str, model_name: str, compiler_options=None):
             compiler_options['expand_mx'] = True
             raise_expand_warning = True
 
+        if compiler_options['cache_folder'] is not None:
+            from .cache_store import CacheStore
+            store = CacheStore(compiler_options['cache_folder'], compiler_options['cache_size_limit'])
+            load, save = store.load, store.save
+        else:
+            load, save = load_model, save_model
+
         try:
-            return load_model(model_folder, model_name, compiler_options)
+            return load(model_folder, model_name, compiler_options)
         except (FileNotFoundError, InvalidCacheError):
             if raise_expand_warning:
                 logger.warning("Caching implies expanding to SX. Setting 'expand_mx' to True.")
-            model = _compile_model(model_folder, model_name, compiler_options)
-            save_model(model_folder, model_name, model, compiler_options)
+            model, file_names = _compile_model(model_folder, model_name, compiler_options)
+            save(model_folder, model_name, model, compiler_options, file_names)
             return model
     else:
-        return _compile_model(model_folder, model_name, compiler_options)
+        model, _ = _compile_model(model_folder, model_name, compiler_options)
+        return model
 
 
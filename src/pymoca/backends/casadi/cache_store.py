@@ -0,0 +1,255 @@
+"""
+A folder of cached models, shared between models, compiler options and
+processes.
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import time
+import uuid
+from typing import Dict, List
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from . import api
+from .model import Model
+from ._options import _merge_default_options
+
+logger = logging.getLogger("pymoca")
+
+_LOCK_FILE = '.lock'
+_DEPENDENCIES_FILE = 'dependencies.pickle'
+_TMP_PREFIX = '.tmp-'
+
+# Temporary folders left behind by processes that died are removed after
+# this many seconds.
+_TMP_MAX_AGE = 24 * 3600
+
+
+class CacheStore:
+    """
+    Folder with cached models, with multiple entries per model. Entries are
+    keyed by the model name and compiler options, and by a hash over the
+    contents of the Modelica files the model was compiled from.
+
+    Entries are written to a temporary folder first, and then renamed into
+    place, so that readers never see partial entries. A lock file guards
+    against entries being evicted while they are being loaded. When a size
+    limit is given, the least recently used entries are evicted when it is
+    exceeded.
+
+    The folder layout is::
+
+        <folder>/<key of model name and options>/<hash of the sources>/
+    """
+
+    def __init__(self, folder: str, size_limit: int = None):
+        """
+        :param folder: Folder to store the entries in.
+        :param size_limit: Maximum total size of all entries in bytes, or None for no limit.
+        """
+        self.folder = folder
+        self.size_limit = size_limit
+
+    @contextlib.contextmanager
+    def _lock(self, shared: bool = False):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, _LOCK_FILE), 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                # Windows has no shared locks
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _model_folder(self, model_name: str, compiler_options: Dict[str, str]) -> str:
+        key = repr((model_name, sorted(api._cache_options(compiler_options).items())))
+        return os.path.join(self.folder, hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+
+    @staticmethod
+    def _store_options(compiler_options: Dict[str, str]) -> Dict[str, str]:
+        # Entries are always validated by the hash of their sources
+        compiler_options = _merge_default_options(compiler_options)
+        compiler_options['hash_check'] = True
+        compiler_options['mtime_check'] = False
+        return compiler_options
+
+    def load(self, model_folder: str, model_name: str, compiler_options: Dict[str, str]) -> Model:
+        """
+        Loads the entry of the model that matches the compiler options and
+        the current contents of its Modelica files.
+
+        :param model_folder: Folder with the Modelica files of the model.
+        :param model_name: Name of the model.
+        :param compiler_options: Dictionary of compiler options.
+
+        :returns: CachedModel instance.
+
+        :raises InvalidCacheError: If there is no matching entry.
+        """
+        compiler_options = self._store_options(compiler_options)
+        folders = [model_folder] + compiler_options['library_folders']
+        entries_folder = self._model_folder(model_name, compiler_options)
+
+        with self._lock(shared=True):
+            try:
+                entries = [e for e in os.listdir(entries_folder) if not e.startswith(_TMP_PREFIX)]
+            except FileNotFoundError:
+                entries = []
+
+            # Try the most recently used entries first. Files shared by
+            # multiple entries are only hashed once, and only files whose
+            # size or modification time changed are read at all.
+            entries.sort(key=lambda e: os.path.getmtime(os.path.join(entries_folder, e)), reverse=True)
+            file_hashes = {}
+
+            for entry in entries:
+                entry_folder = os.path.join(entries_folder, entry)
+                try:
+                    with open(os.path.join(entry_folder, _DEPENDENCIES_FILE), 'rb') as f:
+                        dependencies, file_stats = pickle.load(f)
+                    old_file_stats = file_stats.copy()
+                    dependency_hash = api._dependency_hash(folders, dependencies, compiler_options,
+                                                           file_hashes, file_stats)
+                except (FileNotFoundError, IndexError):
+                    continue
+
+                if dependency_hash != entry:
+                    continue
+
+                # Store the stats of files that did not change, but whose
+                # stats did, such that they are not read again next time.
+                if file_stats != old_file_stats:
+                    api._write_pickle(os.path.join(entry_folder, _DEPENDENCIES_FILE), (dependencies, file_stats))
+
+                # We already checked the hash
+                compiler_options['hash_check'] = False
+                model = api.load_model(model_folder, model_name, compiler_options, entry_folder)
+
+                # Mark as recently used
+                with contextlib.suppress(OSError):
+                    os.utime(entry_folder)
+
+                logger.info("Loaded {} from cache entry {}".format(model_name, entry_folder))
+                return model
+
+        raise api.InvalidCacheError("No cache entry for model {}".format(model_name))
+
+    def save(self, model_folder: str, model_name: str, model: Model, compiler_options: Dict[str, str],
+             dependency_files: List[str] = None) -> None:
+        """
+        Adds an entry for the model, and evicts old entries if the size limit
+        is exceeded.
+
+        :param model_folder: Folder with the Modelica files of the model.
+        :param model_name: Name of the model.
+        :param model: Model instance.
+        :param compiler_options: Dictionary of compiler options.
+        :param dependency_files: Modelica files the model was compiled from.
+                                 Defaults to all files in the model and library folders.
+        """
+        compiler_options = self._store_options(compiler_options)
+        folders = [model_folder] + compiler_options['library_folders']
+        entries_folder = self._model_folder(model_name, compiler_options)
+
+        if dependency_files is None:
+            dependency_files = api._model_files(folders)
+        dependencies = api._relative_dependencies(folders, dependency_files)
+        file_stats = {}
+        entry = api._dependency_hash(folders, dependencies, compiler_options, file_stats=file_stats)
+        entry_folder = os.path.join(entries_folder, entry)
+
+        # Saving (and code generation) can take long, so we do so outside
+        # of the lock, in a folder that no one else looks at.
+        tmp_folder = os.path.join(entries_folder, _TMP_PREFIX + uuid.uuid4().hex)
+        os.makedirs(tmp_folder)
+        try:
+            api.save_model(model_folder, model_name, model, compiler_options, dependency_files, tmp_folder)
+            with open(os.path.join(tmp_folder, _DEPENDENCIES_FILE), 'wb') as f:
+                pickle.dump((dependencies, file_stats), f, protocol=-1)
+
+            with self._lock():
+                try:
+                    os.rename(tmp_folder, entry_folder)
+                except OSError:
+                    # Another process already added the same entry
+                    if not os.path.isdir(entry_folder):
+                        raise
+                else:
+                    logger.info("Added cache entry {}".format(entry_folder))
+
+                self._evict(keep=entry_folder)
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def _entries(self):
+        now = time.time()
+        for model_key in os.listdir(self.folder):
+            entries_folder = os.path.join(self.folder, model_key)
+            if not os.path.isdir(entries_folder):
+                continue
+            for entry in os.listdir(entries_folder):
+                entry_folder = os.path.join(entries_folder, entry)
+                if not entry.startswith(_TMP_PREFIX):
+                    yield entry_folder
+                else:
+                    with contextlib.suppress(OSError):
+                        if now - os.path.getmtime(entry_folder) > _TMP_MAX_AGE:
+                            shutil.rmtree(entry_folder, ignore_errors=True)
+
+    @staticmethod
+    def _size(folder: str) -> int:
+        size = 0
+        for root, dirs, files in os.walk(folder):
+            for item in files:
+                with contextlib.suppress(OSError):
+                    size += os.path.getsize(os.path.join(root, item))
+        return size
+
+    def _evict(self, keep: str = None) -> None:
+        # Assumes the lock is held
+        if self.size_limit is None:
+            return
+
+        entries = [(os.path.getmtime(e), self._size(e), e) for e in self._entries()]
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, entry_folder in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            if entry_folder == keep:
+                continue
+
+            # Rename first, so that the entry disappears at once
+            trash_folder = os.path.join(os.path.dirname(entry_folder), _TMP_PREFIX + uuid.uuid4().hex)
+            try:
+                os.rename(entry_folder, trash_folder)
+            except OSError:
+                continue
+            shutil.rmtree(trash_folder, ignore_errors=True)
+
+            logger.info("Evicted cache entry {}".format(entry_folder))
+            total_size -= size
+
+    def evict(self) -> None:
+        """
+        Evicts the least recently used entries until the size limit is met.
+        """
+        with self._lock():
+            self._evict()
@@ -1,16 +1,18 @@
-from collections import namedtuple, OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
 import casadi as ca
 import numpy as np
 import itertools
 import logging
 import re
 import sys
+import weakref
 
 from pymoca import ast
 
 from .alias_relation import AliasRelation
 from .mtensor import _MTensor
 from ._options import _merge_default_options
+from .simplification_report import SimplificationReport
 
 logger = logging.getLogger("pymoca")
 
@@ -42,6 +44,18 @@ class Variable:
         self.initialGuess = 0
         self.free = False
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+
+        # Let the models this variable belongs to know that it changed
+        for model in self.__dict__.get('_models', ()):
+            model._modified()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_models', None)
+        return state
+
     def __str__(self):
         return self.symbol.name()
 
@@ -75,10 +89,98 @@ class Variable:
 
 DelayArgument = namedtuple('DelayArgument', ['expr', 'duration'])
 
+_TRACKED_LISTS = {'states', 'der_states', 'alg_states', 'inputs', 'constants', 'parameters',
+                  'equations', 'initial_equations', 'delay_arguments'}
+
+
+class _TrackedList(list):
+    # List of a model that lets the model know when it is modified in place,
+    # and registers the model with the variables that are added to it.
+
+    def __init__(self, model, iterable=()):
+        super().__init__(iterable)
+        self._model = model
+        self._track(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def _track(self, items):
+        for item in items:
+            if isinstance(item, Variable):
+                models = item.__dict__.get('_models')
+                if models is None:
+                    models = item.__dict__['_models'] = weakref.WeakSet()
+                models.add(self._model)
+
+    def __setitem__(self, key, value):
+        self._model._modified()
+        if isinstance(key, slice):
+            value = list(value)
+            self._track(value)
+        else:
+            self._track([value])
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._model._modified()
+        super().__delitem__(key)
+
+    def __iadd__(self, other):
+        other = list(other)
+        self._model._modified()
+        self._track(other)
+        return super().__iadd__(other)
+
+    def __imul__(self, n):
+        self._model._modified()
+        return super().__imul__(n)
+
+    def append(self, item):
+        self._model._modified()
+        self._track([item])
+        super().append(item)
+
+    def extend(self, items):
+        items = list(items)
+        self._model._modified()
+        self._track(items)
+        super().extend(items)
+
+    def insert(self, index, item):
+        self._model._modified()
+        self._track([item])
+        super().insert(index, item)
+
+    def pop(self, *args):
+        self._model._modified()
+        return super().pop(*args)
+
+    def remove(self, item):
+        self._model._modified()
+        super().remove(item)
+
+    def clear(self):
+        self._model._modified()
+        super().clear()
+
+    def sort(self, *args, **kwargs):
+        self._model._modified()
+        super().sort(*args, **kwargs)
+
+    def reverse(self):
+        self._model._modified()
+        super().reverse()
+
 
 # noinspection PyUnresolvedReferences
 class Model:
 
+    # Incremented on every change of the model, its lists and their
+    # variables, such that cached functions can cheaply be checked for
+    # being up to date.
+    _generation = 0
+
     def __init__(self):
         self.states = []
         self.der_states = []
@@ -98,6 +200,17 @@ class Model:
         self.simplified_variables = []
         self._expand_mx_func = lambda x: x
         self.optimization_attributes = {}
+        self.simplification_report = None
+        self._functions = {}
+
+    def __setattr__(self, name, value):
+        if name in _TRACKED_LISTS and not (isinstance(value, _TrackedList) and value._model is self):
+            value = _TrackedList(self, value)
+        super().__setattr__(name, value)
+        self._modified()
+
+    def _modified(self):
+        self.__dict__['_generation'] = self._generation + 1
 
     def __str__(self):
         r = ""
@@ -151,6 +264,55 @@ class Model:
         durations = ca.substitute([ca.MX(argument.duration) for argument in delay_arguments], symbols, values)
         return [DelayArgument(expr, duration) for expr, duration in zip(exprs, durations)]
 
+    @staticmethod
+    def _resolve_expressions(symbols, values):
+        """
+        Substitutes the values of the symbols into each other, such that no
+        value depends on any of the symbols anymore.
+
+        The values are resolved in topological order of their dependencies,
+        one level of the dependency graph at a time. Every value is therefore
+        substituted exactly once.
+
+        :param symbols: list of symbols
+        :param values: list of values of these symbols
+        :return: list of resolved values
+        """
+        values = list(values)
+        index = {s.name(): i for i, s in enumerate(symbols)}
+
+        dependencies = [{index[x.name()] for x in ca.symvar(v) if x.name() in index} for v in values]
+        dependents = [[] for _ in values]
+        for i, deps in enumerate(dependencies):
+            for j in deps:
+                dependents[j].append(i)
+
+        n_unresolved = [len(deps) for deps in dependencies]
+        level = [i for i, n in enumerate(n_unresolved) if n == 0]
+
+        while level:
+            # All dependencies of this level have been resolved already
+            deps = sorted(set().union(*(dependencies[i] for i in level)))
+            if deps:
+                resolved = ca.substitute([values[i] for i in level],
+                                         [symbols[j] for j in deps], [values[j] for j in deps])
+                for i, v in zip(level, resolved):
+                    values[i] = v
+
+            next_level = []
+            for i in level:
+                for k in dependents[i]:
+                    n_unresolved[k] -= 1
+                    if n_unresolved[k] == 0:
+                        next_level.append(k)
+            level = next_level
+
+        cyclic = [symbols[i].name() for i, n in enumerate(n_unresolved) if n > 0]
+        if cyclic:
+            raise Exception("Cyclic dependency in the expressions of {}".format(", ".join(cyclic)))
+
+        return values
+
 
     @staticmethod
     def _expand_simplify_mx(equations):
@@ -367,26 +529,262 @@ class Model:
     def simplify(self, options):
         options = _merge_default_options(options)
 
-        alg_states_left = 0
+        # Simplification also modifies lists in place
+        self._functions.clear()
 
-        for simplification_iter in range(SIMPLIFICATION_LOOP_LIMIT):
-            if options.get('iterative_simplification', False):
-                logger.info("Simplification iteration {}".format(simplification_iter + 1))
+        if options['simplification_report'] or options['simplification_report_file'] is not None:
+            self.simplification_report = SimplificationReport()
+        else:
+            self.simplification_report = None
 
+        if options.get('iterative_simplification', False):
+            self._simplify_iteratively(options)
+        else:
+            if self.simplification_report is not None:
+                self.simplification_report.iterations = 1
             self._simplify_once(options)
 
-            if options.get('iterative_simplification', False) and alg_states_left != len(self.alg_states):
-                alg_states_left = len(self.alg_states)
-                simplification_iter += 1
+        logger.info("Finished model simplification")
+
+        if options['simplification_report_file'] is not None:
+            self.simplification_report.write_json(options['simplification_report_file'])
+
+        return self.simplification_report
+
+    def _simplify_iteratively(self, options):
+        """
+        Repeats the simplification passes until no more variables can be
+        eliminated. Only the equations that changed in an iteration are
+        simplified again in the next one, so the work on the equations scales
+        with the number of eliminations instead of with the size of the model.
+
+        :param options: dictionary of compiler options
+        """
+        # Passes that work on all equations at once are applied after the
+        # iterations have converged. Vectors only need to be expanded once.
+        global_passes = ['reduce_affine_expression', 'common_subexpression_elimination']
+        first_options = dict(options, **{k: False for k in global_passes})
+        iteration_options = dict(first_options, expand_vectors=False)
+
+        # Equations and initial equations by id, with an index of the
+        # equations each symbol occurs in
+        equations = OrderedDict()
+        equation_symbols = {}
+        occurrences = defaultdict(set)
+        symbols = {}
+        initial_ids = []
+
+        def add_equation(i, eq):
+            equations[i] = eq
+            names = set()
+            for x in ca.symvar(eq):
+                names.add(x.name())
+                symbols[x.name()] = x
+                occurrences[x.name()].add(i)
+            equation_symbols[i] = names
+
+        def remove_equation(i):
+            for name in equation_symbols.pop(i):
+                occurrences[name].discard(i)
+            del equations[i]
+
+        def progress():
+            # Every elimination adds a simplified variable, except for
+            # algebraic states that become constants.
+            return len(self.simplified_variables), len(self.alg_states)
+
+        next_id = 0
+
+        # The first iteration visits all equations
+        active = None
+
+        for simplification_iter in range(SIMPLIFICATION_LOOP_LIMIT):
+            logger.info("Simplification iteration {} ({} equations)".format(
+                simplification_iter + 1, len(self.equations) if active is None else len(active)))
+
+            if self.simplification_report is not None:
+                self.simplification_report.iterations = simplification_iter + 1
+
+            state = progress()
+            n_simplified_variables = len(self.simplified_variables)
+
+            if active is None:
+                fingerprints = {str(eq) for eq in self.equations}
+                self._simplify_once(first_options)
+
+                # Initial equations are not simplified themselves, but the
+                # eliminations of later iterations are substituted into them.
+                for eq in self.initial_equations:
+                    add_equation(next_id, eq)
+                    initial_ids.append(next_id)
+                    next_id += 1
+                self.initial_equations = []
+
+                probes = []
+                probe_values = []
             else:
+                active_set = set(active)
+                active_equations = [equations[i] for i in active]
+                fingerprints = {str(eq) for eq in active_equations}
+
+                # Symbols that also occur in equations outside of this
+                # iteration. We pass them along as the only initial
+                # equations, which all passes substitute into, to find out
+                # what they were replaced with.
+                der_symbols = {s.symbol.name(): d.symbol for s, d in zip(self.states, self.der_states)}
+                probe_names = set()
+                for i in active:
+                    for name in equation_symbols[i]:
+                        probe_names.add(name)
+                        if name in der_symbols:
+                            probe_names.add(der_symbols[name].name())
+                            symbols.setdefault(der_symbols[name].name(), der_symbols[name])
+                probes = [symbols[name] for name in sorted(probe_names) if occurrences[name] - active_set]
+
+                self.equations = active_equations
+                self.initial_equations = probes
+
+                self._simplify_once(iteration_options)
+
+                probe_values = self.initial_equations
+                self.initial_equations = []
+                assert len(probe_values) == len(probes)
+
+                # Equations that did not change need not be visited again
+                for i in active:
+                    remove_equation(i)
+
+            active = []
+            for eq in self.equations:
+                add_equation(next_id, eq)
+                if str(eq) not in fingerprints and not eq.is_constant():
+                    active.append(next_id)
+                next_id += 1
+
+            # Bring the other equations up to date with the eliminations.
+            # Parameters and constants can also be eliminated without
+            # occurring in any of the active equations.
+            changed = [(x, v) for x, v in zip(probes, probe_values) if not (v.is_symbolic() and v.name() == x.name())]
+            probed = {x.name() for x in probes}
+            for v in self.simplified_variables[n_simplified_variables:]:
+                name = v.symbol.name()
+                if name not in probed and occurrences[name]:
+                    changed.append((v.symbol, ca.MX(v.value)))
+
+            if changed:
+                affected = sorted(set().union(*(occurrences[x.name()] for x, _ in changed)))
+                variables, values = zip(*changed)
+                substituted = ca.substitute([equations[i] for i in affected], list(variables), list(values))
+                for i, eq in zip(affected, substituted):
+                    remove_equation(i)
+                    add_equation(i, eq)
+                initial_set = set(initial_ids)
+                active = sorted(set(active).union(
+                    i for i in affected if i not in initial_set and not equations[i].is_constant()))
+
+            # Eliminations of parameters and constants can enable further
+            # eliminations in their metadata, even if no equation changed.
+            if not active and progress() == state:
                 break
         else:
             logger.warning("Simplification exceeded maximum iteration limit.")
 
-        logger.info("Finished model simplification")
+        # Keep the relative order of the equations in each iteration
+        initial_set = set(initial_ids)
+        self.equations = [equations[i] for i in sorted(equations) if i not in initial_set]
+        self.initial_equations = [equations[i] for i in initial_ids]
+
+        if any(options[k] for k in global_passes):
+            final_options = dict(options, eliminable_variable_expression=None)
+            for k in ['expand_vectors', 'replace_parameter_expressions', 'replace_constant_expressions',
+                      'eliminate_constant_assignments', 'replace_parameter_values', 'replace_constant_values',
+                      'factor_and_simplify_equations', 'detect_aliases']:
+                final_options[k] = False
+            self._simplify_once(final_options)
+
+    def _begin_pass(self, name):
+        # Ends the previous pass of the simplification report, if any
+        if self.simplification_report is not None:
+            self.simplification_report.begin(name, self)
+
+    def _end_pass(self):
+        if self.simplification_report is not None:
+            self.simplification_report.end(self)
+
+    @staticmethod
+    def _incidence_aliases(equations, names):
+        """
+        Finds the equations of the form c * (a - b) = 0 and c * (a + b) = 0,
+        using the incidence structure and linear coefficients of all equations
+        at once.
+
+        :param equations: list of equations
+        :param names: names of the variables that can be aliased
+        :return: dictionary mapping the equation index to the two symbols and
+                 whether the alias is negative, or None if the equations
+                 cannot be analyzed this way.
+        """
+        if len(equations) == 0 or not all(eq.shape == (1, 1) for eq in equations):
+            return None
+
+        eqs_mx = ca.vertcat(*equations)
+        s_mx = ca.symvar(eqs_mx)
+        if not all(x.shape == (1, 1) for x in s_mx):
+            return None
+
+        # A single vector input, as functions with many inputs are slow
+        x_mx = ca.MX.sym('x', len(s_mx))
+        eqs_mx = ca.substitute([eqs_mx], s_mx, ca.vertsplit(x_mx))[0]
+        try:
+            f = ca.Function('alias_detection', [x_mx], [eqs_mx]).expand()
+        except RuntimeError:
+            # Function calls that cannot be expanded
+            return None
+
+        x = ca.SX.sym('x', len(s_mx))
+        eqs_sx = f.call([x])[0]
+
+        jac = ca.jacobian(eqs_sx, x)
+        rows, cols = (np.array(v, dtype=int) for v in jac.sparsity().get_triplet())
+
+        # Nonzeros of the rows with exactly two incident variables, with the
+        # two nonzeros of a row next to each other.
+        counts = np.bincount(rows, minlength=len(equations))
+        nz = np.flatnonzero(counts[rows] == 2)
+        nz = nz[np.argsort(rows[nz], kind='stable')]
+
+        if len(nz) == 0:
+            return {}
+
+        coefficients = jac.nonzeros()
+        residuals = np.array(ca.Function('residual', [x], [eqs_sx])(np.zeros(x.shape[0]))).ravel()
+
+        candidates = {}
+        for k0, k1 in zip(nz[::2], nz[1::2]):
+            row = rows[k0]
+            c0, c1 = coefficients[k0], coefficients[k1]
+            if not (c0.is_constant() and c1.is_constant()) or residuals[row] != 0.0:
+                continue
+
+            deps = [s_mx[cols[k0]], s_mx[cols[k1]]]
+            if not all(d.name() in names for d in deps):
+                continue
+
+            c0, c1 = float(c0), float(c1)
+            if c0 == 0.0 or abs(c0) != abs(c1):
+                continue
+
+            # Keep the order in which the symbols appear in the equation
+            order = [d.name() for d in ca.symvar(equations[row])]
+            deps.sort(key=lambda d: order.index(d.name()))
+
+            candidates[row] = (deps, c0 == c1)
+
+        return candidates
 
     def _simplify_once(self, options):
         if options['expand_vectors'] and options['expand_mx']:
+            self._begin_pass('expand_vectors')
             # If we are _not_ expanding MX to SX, we do the expansion of
             # vectors first, such that we are be able to detect more aliases
             # (e.g individual array elements, or elements in a for loop).
@@ -399,6 +797,7 @@ class Model:
             self.initial_equations = self._expand_simplify_mx(self.initial_equations)
 
         if options['replace_parameter_expressions']:
+            self._begin_pass('replace_parameter_expressions')
             logger.info("Replacing parameter expressions")
 
             simple_parameters, symbols, values = [], [], []
@@ -425,14 +824,7 @@ class Model:
             if len(values) > 0:
                 # Resolve expressions that include other, non-simple parameter
                 # expressions.
-                for i in range(SUBSTITUTE_LOOP_LIMIT):
-                    new_values = ca.substitute(values, symbols, values)
-                    converged = ca.is_equal(ca.veccat(*values), ca.veccat(*new_values), CASADI_COMPARISON_DEPTH)
-                    values = new_values
-                    if converged:
-                        break
-                else:
-                    logger.warning("Substitution of expressions exceeded maximum iteration limit.")
+                values = self._resolve_expressions(symbols, values)
 
                 if len(self.equations) > 0:
                     self.equations = ca.substitute(self.equations, symbols, values)
@@ -445,6 +837,7 @@ class Model:
                 self._substitute_metadata(symbols, values)
 
         if options['replace_constant_expressions']:
+            self._begin_pass('replace_constant_expressions')
             logger.info("Replacing constant expressions")
 
             simple_constants, symbols, values = [], [], []
@@ -462,14 +855,7 @@ class Model:
             if len(values) > 0:
                 # Resolve expressions that include other, non-simple parameter
                 # expressions.
-                for i in range(SUBSTITUTE_LOOP_LIMIT):
-                    new_values = ca.substitute(values, symbols, values)
-                    converged = ca.is_equal(ca.veccat(*values), ca.veccat(*new_values), CASADI_COMPARISON_DEPTH)
-                    values = new_values
-                    if converged:
-                        break
-                else:
-                    logger.warning("Substitution of expressions exceeded maximum iteration limit.")
+                values = self._resolve_expressions(symbols, values)
 
                 if len(self.equations) > 0:
                     self.equations = ca.substitute(self.equations, symbols, values)
@@ -482,6 +868,7 @@ class Model:
                 self._substitute_metadata(symbols, values)
 
         if options['eliminate_constant_assignments']:
+            self._begin_pass('eliminate_constant_assignments')
             logger.info("Elimating constant variable assignments")
 
             alg_states = OrderedDict([(s.symbol.name(), s) for s in self.alg_states])
@@ -529,6 +916,7 @@ class Model:
             self.equations = reduced_equations
 
         if options['replace_parameter_values']:
+            self._begin_pass('replace_parameter_values')
             logger.info("Replacing parameter values")
 
             # N.B. Any parameter expression elimination must be done first.
@@ -551,6 +939,7 @@ class Model:
             self._substitute_metadata(symbols, values)
 
         if options['replace_constant_values']:
+            self._begin_pass('replace_constant_values')
             logger.info("Replacing constant values")
 
             # N.B. Any parameter expression elimination must be done first.
@@ -578,6 +967,7 @@ class Model:
             self._substitute_metadata(symbols, values)
 
         if options['eliminable_variable_expression'] is not None:
+            self._begin_pass('eliminable_variable_expression')
             logger.info("Elimating variables that match the regular expression {}".format(options['eliminable_variable_expression']))
 
             # Due to CasADi's ca.is_equal not properly matching short-
@@ -737,10 +1127,13 @@ class Model:
             self._substitute_metadata(variables, values)
 
         if options['expand_vectors'] and not options['expand_mx']:
+            self._begin_pass('expand_vectors')
+
             # If we are _not_ expanding MX to SX, we do the expansion of vectors here
             self._expand_vectors()
 
         if options['factor_and_simplify_equations']:
+            self._begin_pass('factor_and_simplify_equations')
             # Operations that preserve the equivalence of an equation
             # TODO: There may be more, but this is the most frequent set
             unary_ops = ca.OP_NEG, ca.OP_FABS, ca.OP_SQRT
@@ -789,6 +1182,7 @@ class Model:
             self.equations = simplified_equations
 
         if options['detect_aliases']:
+            self._begin_pass('detect_aliases')
             logger.info("Detecting aliases")
 
             states = OrderedDict([(s.symbol.name(), s) for s in self.states])
@@ -862,48 +1256,59 @@ class Model:
 
                 return False
 
-            reduced_equations = []
-            for eq in self.equations:
-                # We do fast checks first, and the slower (but more generic)
-                # checks after.
-                if eq.n_dep() == 2 and (eq.is_op(ca.OP_SUB) or eq.is_op(ca.OP_ADD)):
-                    if eq.dep(0).is_symbolic() and eq.dep(1).is_symbolic():
-                        deps = ca.symvar(eq)
-                        assert len(deps) == 2
-                        if _make_alias(deps, eq.is_op(ca.OP_ADD)): continue
-                elif options['expand_vectors'] and not options['expand_mx']:
-                    # Equation might have many "shadow" dependencies due to
-                    # vector/array expansion. By using .expand() and SX
-                    # symbols for the evaluation, we can figure out what the
-                    # real dependencies are.
-                    s_mx = ca.symvar(eq)
-                    assert all(x.shape == (1, 1) for x in s_mx), "Vector/Matrix SX symbols cannot be mapped"
-                    f = ca.Function('tmp', s_mx, [eq]).expand()
-                    s_sx = [ca.SX.sym(x.name(), *x.shape) for x in s_mx]
-                    eq_sx = f.call(s_sx)[0]
-
-                    # Reduced dependencies
-                    deps_sx = ca.symvar(eq_sx)
-
-                    if len(deps_sx) == 2:
-                        # Map SX dependencies back to MX dependencies
-                        deps_map = {k: v for v, k in enumerate(s_sx)}
-                        deps_mx = [s_mx[deps_map[x]] for x in deps_sx]
-
-                        # Simple add/sub expressions in SX equation
-                        if eq_sx.n_dep() == 2 and (eq_sx.is_op(ca.OP_SUB) or eq_sx.is_op(ca.OP_ADD)):
-                            if eq_sx.dep(0).is_symbolic() and eq_sx.dep(1).is_symbolic():
-                                if _make_alias(deps_mx, eq_sx.is_op(ca.OP_ADD)): continue
-
-                        # Check with substitute, which is a more expensive operation
-                        if ca.substitute(eq_sx, deps_sx[0], deps_sx[1]).is_zero():
-                            if _make_alias(deps_mx): continue
-
-                        elif ca.substitute(eq_sx, deps_sx[0], -1 * deps_sx[1]).is_zero():
-                            if _make_alias(deps_mx, True): continue
+            candidates = None
+            if options['incidence_alias_detection']:
+                # Find all alias equations in one go
+                candidates = self._incidence_aliases(self.equations, all_states)
+                if candidates is None:
+                    logger.info("Falling back to detecting aliases equation by equation")
 
-                # Keep this equation
-                reduced_equations.append(eq)
+            if candidates is not None:
+                reduced_equations = [eq for i, eq in enumerate(self.equations)
+                                     if not (i in candidates and _make_alias(*candidates[i]))]
+            else:
+                reduced_equations = []
+                for eq in self.equations:
+                    # We do fast checks first, and the slower (but more generic)
+                    # checks after.
+                    if eq.n_dep() == 2 and (eq.is_op(ca.OP_SUB) or eq.is_op(ca.OP_ADD)):
+                        if eq.dep(0).is_symbolic() and eq.dep(1).is_symbolic():
+                            deps = ca.symvar(eq)
+                            assert len(deps) == 2
+                            if _make_alias(deps, eq.is_op(ca.OP_ADD)): continue
+                    elif options['expand_vectors'] and not options['expand_mx']:
+                        # Equation might have many "shadow" dependencies due to
+                        # vector/array expansion. By using .expand() and SX
+                        # symbols for the evaluation, we can figure out what the
+                        # real dependencies are.
+                        s_mx = ca.symvar(eq)
+                        assert all(x.shape == (1, 1) for x in s_mx), "Vector/Matrix SX symbols cannot be mapped"
+                        f = ca.Function('tmp', s_mx, [eq]).expand()
+                        s_sx = [ca.SX.sym(x.name(), *x.shape) for x in s_mx]
+                        eq_sx = f.call(s_sx)[0]
+
+                        # Reduced dependencies
+                        deps_sx = ca.symvar(eq_sx)
+
+                        if len(deps_sx) == 2:
+                            # Map SX dependencies back to MX dependencies
+                            deps_map = {k: v for v, k in enumerate(s_sx)}
+                            deps_mx = [s_mx[deps_map[x]] for x in deps_sx]
+
+                            # Simple add/sub expressions in SX equation
+                            if eq_sx.n_dep() == 2 and (eq_sx.is_op(ca.OP_SUB) or eq_sx.is_op(ca.OP_ADD)):
+                                if eq_sx.dep(0).is_symbolic() and eq_sx.dep(1).is_symbolic():
+                                    if _make_alias(deps_mx, eq_sx.is_op(ca.OP_ADD)): continue
+
+                            # Check with substitute, which is a more expensive operation
+                            if ca.substitute(eq_sx, deps_sx[0], deps_sx[1]).is_zero():
+                                if _make_alias(deps_mx): continue
+
+                            elif ca.substitute(eq_sx, deps_sx[0], -1 * deps_sx[1]).is_zero():
+                                if _make_alias(deps_mx, True): continue
+
+                    # Keep this equation
+                    reduced_equations.append(eq)
 
             # Eliminate alias variables
             variables, values = [], []
@@ -972,7 +1377,6 @@ class Model:
                     fixed = ca.fmax(fixed, alias_state.fixed)
 
                     self._save_simplified_variable(alias_state, canonical_state.symbol * sign)
-                    self._substitute_metadata([alias_state.symbol], [canonical_state.symbol*sign])
                     del all_states[alias]
 
                 assert isinstance(aliases, set)
@@ -984,6 +1388,12 @@ class Model:
                 canonical_state.nominal = nominal
                 canonical_state.fixed = fixed
 
+            # Substitute all aliases in the metadata in one go. The values are
+            # canonical variables, which are never aliases themselves, so this
+            # is equivalent to substituting them one by one.
+            if len(variables) > 0:
+                self._substitute_metadata(variables, values)
+
             self.states = [v for k, v in all_states.items() if k in states]
             self.der_states = [v for k, v in all_states.items() if k in der_states]
             self.alg_states = [v for k, v in all_states.items() if k in alg_states]
@@ -999,6 +1409,7 @@ class Model:
                 self.delay_arguments = self._substitute_delay_arguments(self.delay_arguments, variables, values)
 
         if options['reduce_affine_expression']:
+            self._begin_pass('reduce_affine_expression')
             logger.info("Collapsing model into an affine expression")
 
             for equation_list in ['equations', 'initial_equations']:
@@ -1036,19 +1447,88 @@ class Model:
                     equations = [ca.reshape(ca.mtimes(A, states_vector), equations.shape) + b]
                     setattr(self, equation_list, equations)
 
+        if options['common_subexpression_elimination']:
+            self._begin_pass('common_subexpression_elimination')
+            logger.info("Eliminating common subexpressions")
+
+            if not hasattr(ca, 'cse'):
+                raise Exception("Common subexpression elimination requires CasADi 3.6 or newer")
+
+            # Equations, initial equations and delay arguments end up in the
+            # same functions, so we share subexpressions between all of them.
+            n_equations = len(self.equations)
+            n_initial_equations = len(self.initial_equations)
+            expressions = list(itertools.chain(
+                self.equations, self.initial_equations,
+                (ca.MX(x.expr) for x in self.delay_arguments),
+                (ca.MX(x.duration) for x in self.delay_arguments)))
+
+            if len(expressions) > 0:
+                n_nodes = self._n_nodes(expressions)
+                expressions = ca.cse(expressions)
+                logger.info("Common subexpression elimination removed {} of {} nodes".format(
+                    n_nodes - self._n_nodes(expressions), n_nodes))
+
+                self.equations = expressions[:n_equations]
+                self.initial_equations = expressions[n_equations:n_equations + n_initial_equations]
+                delay_arguments = expressions[n_equations + n_initial_equations:]
+                n_delay_arguments = len(self.delay_arguments)
+                self.delay_arguments = [DelayArgument(expr, duration) for expr, duration in zip(
+                    delay_arguments[:n_delay_arguments], delay_arguments[n_delay_arguments:])]
+
         if options['expand_mx']:
+            self._begin_pass('expand_mx')
             logger.info("Expanded MX functions will be returned")
             self._expand_mx_func = lambda x: x.expand()
 
+        self._end_pass()
+
+        self._functions.clear()
+
         logger.info("Finished model simplification")
 
+    @staticmethod
+    def _n_nodes(expressions):
+        symbols = ca.symvar(ca.veccat(*expressions))
+        return ca.Function('n_nodes', symbols, expressions, {'max_io': 0}).n_nodes()
+
     def _save_simplified_variable(self, var, value = None):
         if value is not None:
             var.value = value
         self.simplified_variables.append(var)
 
+    def _cached_function(self, name, build):
+        # Functions are only rebuilt when the model changed since they were
+        # last built.
+        try:
+            generation, function = self._functions[name]
+        except KeyError:
+            pass
+        else:
+            if generation == self._generation:
+                return function
+
+        function = build()
+        self._functions[name] = (self._generation, function)
+        return function
+
     @property
     def dae_residual_function(self):
+        return self._cached_function('dae_residual', self._build_dae_residual_function)
+
+    @property
+    def initial_residual_function(self):
+        return self._cached_function('initial_residual', self._build_initial_residual_function)
+
+    @property
+    def variable_metadata_function(self):
+        return self._cached_function('variable_metadata', self._build_variable_metadata_function)
+
+    @property
+    def delay_arguments_function(self):
+        return self._cached_function('delay_arguments', self._build_delay_arguments_function)
+
+    def _build_dae_residual_function(self):
         if hasattr(self, '_states_vector'):
             return self._expand_mx_func(ca.Function('dae_residual', [self.time, self._states_vector, self._der_states_vector,
                                                 self._alg_states_vector, self._inputs_vector, ca.veccat(*self._symbols(self.constants)),
@@ -1059,8 +1539,7 @@ class Model:
                                                 ca.veccat(*self._symbols(self.parameters))], [ca.veccat(*self.equations)] if len(self.equations) > 0 else []))
 
     # noinspection PyUnusedLocal
-    @property
-    def initial_residual_function(self):
+    def _build_initial_residual_function(self):
         if hasattr(self, '_states_vector'):
             return self._expand_mx_func(ca.Function('initial_residual', [self.time, self._states_vector, self._der_states_vector,
                                                 self._alg_states_vector, self._inputs_vector, ca.veccat(*self._symbols(self.constants)),
@@ -1071,8 +1550,7 @@ class Model:
                                                 ca.veccat(*self._symbols(self.parameters))], [ca.veccat(*self.initial_equations)] if len(self.initial_equations) > 0 else []))
 
     # noinspection PyPep8Naming
-    @property
-    def variable_metadata_function(self):
+    def _build_variable_metadata_function(self):
         in_var = ca.veccat(*self._symbols(self.parameters))
         out = []
         is_affine = True
@@ -1132,8 +1610,7 @@ class Model:
         return self._expand_mx_func(ca.Function('variable_metadata', [in_var], out))
 
     # noinspection PyPep8Naming
-    @property
-    def delay_arguments_function(self):
+    def _build_delay_arguments_function(self):
         # We cannot assume that we can ca.horzcat/vertcat all delay arguments
         # and expressions due to shape differences, so instead we flatten our
         # delay expressions and durations into list, i.e. [delay_expr_1,
@@ -0,0 +1,117 @@
+"""
+Statistics of the passes of a model simplification, to help with tuning
+the compiler options for large models.
+"""
+from collections import namedtuple
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Statistics of a single pass. The sizes before and after the pass are
+# dictionaries with the number of equations, variables per category, and
+# expression nodes.
+PassStatistics = namedtuple('PassStatistics', ['name', 'iteration', 'wall_time', 'peak_memory', 'before', 'after'])
+
+_VARIABLE_CATEGORIES = ['states', 'der_states', 'alg_states', 'inputs', 'parameters', 'constants']
+
+
+def _peak_memory():
+    # Peak resident memory of the process in bytes. It is not possible to
+    # reset this high-water mark, so it never decreases between passes.
+    if resource is None:
+        return None
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_memory
+    else:
+        return peak_memory * 1024
+
+
+class SimplificationReport:
+    """
+    Records the wall time, peak memory and model sizes of every pass of
+    Model.simplify.
+    """
+
+    def __init__(self):
+        self.passes = []
+        self.iterations = 0
+        self._current = None
+
+    def begin(self, name, model):
+        """
+        Starts a pass, and ends the pass that was still running.
+
+        :param name: Name of the pass.
+        :param model: Model that is simplified.
+        """
+        sizes = self.end(model)
+        if sizes is None:
+            sizes = self._sizes(model)
+        self._current = (name, self.iterations, sizes, time.perf_counter())
+
+    def end(self, model):
+        """
+        Ends the running pass, if any.
+
+        :param model: Model that is simplified.
+
+        :returns: Sizes of the model after the pass, or None if no pass was running.
+        """
+        if self._current is None:
+            return None
+        name, iteration, before, start = self._current
+        wall_time = time.perf_counter() - start
+        after = self._sizes(model)
+        self.passes.append(PassStatistics(name, iteration, wall_time, _peak_memory(), before, after))
+        self._current = None
+        return after
+
+    @staticmethod
+    def _sizes(model):
+        sizes = {
+            'equations': len(model.equations),
+            'initial_equations': len(model.initial_equations),
+            'delay_arguments': len(model.delay_arguments),
+        }
+        for key in _VARIABLE_CATEGORIES:
+            sizes[key] = len(getattr(model, key))
+        sizes['nodes'] = model._n_nodes(model.equations) if model.equations else 0
+        return sizes
+
+    @property
+    def wall_time(self):
+        return sum(p.wall_time for p in self.passes)
+
+    def to_dict(self):
+        """
+        :returns: Dictionary with the statistics of all passes, that can be serialized as JSON.
+        """
+        return {
+            'iterations': self.iterations,
+            'wall_time': self.wall_time,
+            'passes': [p._asdict() for p in self.passes],
+        }
+
+    def write_json(self, file_name):
+        """
+        :param file_name: Name of the JSON file to write the statistics to.
+        """
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def __str__(self):
+        r = "{:<40} {:>5} {:>10} {:>10} {:>10} {:>12}\n".format(
+            "Pass", "Iter", "Time [s]", "Equations", "Variables", "Nodes")
+        for p in self.passes:
+            r += "{:<40} {:>5} {:>10.4f} {:>10} {:>10} {:>12}\n".format(
+                p.name, p.iteration, p.wall_time,
+                "{}->{}".format(p.before['equations'], p.after['equations']),
+                "{}->{}".format(*(sum(s[k] for k in _VARIABLE_CATEGORIES) for s in (p.before, p.after))),
+                "{}->{}".format(p.before['nodes'], p.after['nodes']))
+        return r
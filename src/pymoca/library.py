@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Lazy, on-demand loading of Modelica libraries.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import fnmatch
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+from . import ast
+
+logger = logging.getLogger("pymoca")
+
+# Comments and strings are stripped before scanning, so that class keywords
+# inside them are not picked up.
+_COMMENT_OR_STRING_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"', re.DOTALL)
+
+_WITHIN_RE = re.compile(r'^\s*within\s*([\w.]*)\s*;')
+
+# Either the start of a class definition, or the end of a (class) scope. Short
+# class definitions (e.g. "type Voltage = Real") do not have an end.
+_CLASS_TOKEN_RE = re.compile(
+    r'\bend\s+(?P<end>\w+)\s*;'
+    r'|(?:\b(?:operator|expandable)\s+)?'
+    r'\b(?:model|package|class|connector|record|block|type|function|operator)\s+'
+    r'(?:extends\s+)?(?P<name>\w+)\s*(?P<short>=)?')
+
+
+def scan_file(text: str) -> Tuple[Tuple[str, ...], List[str]]:
+    """
+    Cheaply determine the "within" clause and the names of the top-level
+    classes in a Modelica file, without parsing it.
+
+    :param text: contents of the Modelica file
+    :return: tuple of the within clause as a tuple of names, and the list of top-level class names
+    """
+    text = _COMMENT_OR_STRING_RE.sub(' ', text)
+
+    within = ()
+    m = _WITHIN_RE.match(text)
+    if m is not None:
+        within = tuple(x for x in m.group(1).split('.') if x)
+        text = text[m.end():]
+
+    names = []
+    stack = []
+    for m in _CLASS_TOKEN_RE.finditer(text):
+        if m.group('end') is not None:
+            # Also matches e.g. "end if;", which will not be on the stack
+            if stack and stack[-1] == m.group('end'):
+                stack.pop()
+        else:
+            name = m.group('name')
+            if not stack and name not in names:
+                names.append(name)
+            if m.group('short') is None:
+                stack.append(name)
+
+    return within, names
+
+
+def _layout_class_name(file_name: str) -> str:
+    # Following the Modelica conventions, a file "A.mo" contains class A, and
+    # "A/package.mo" contains package A.
+    base_name = os.path.basename(file_name)
+    if base_name == 'package.mo':
+        return os.path.basename(os.path.dirname(os.path.abspath(file_name)))
+    else:
+        return os.path.splitext(base_name)[0]
+
+
+class LibraryLoader:
+    """
+    Index of the classes defined in a set of Modelica files. Used as the class
+    loader of an ast.Tree, files are only parsed when a class defined in them
+    is looked up.
+    """
+
+    def __init__(self, file_names: Iterable[str], cache_folder: str = None, workers: int = 1,
+                 build_parse_tree: bool = True):
+        self.file_names = list(file_names)
+        self.cache_folder = cache_folder
+        self.workers = workers
+        self.build_parse_tree = build_parse_tree
+
+        self._file_classes = []  # type: List[List[Tuple[str, ...]]]
+        self._index = OrderedDict()  # type: OrderedDict[Tuple[str, ...], List[int]]
+        self._loaded = set()
+        self.tree = None  # type: ast.Tree
+
+        for i, file_name in enumerate(self.file_names):
+            with open(file_name, 'r') as f:
+                within, names = scan_file(f.read())
+
+            if not names:
+                names = [_layout_class_name(file_name)]
+
+            classes = [within + (name,) for name in names]
+            self._file_classes.append(classes)
+            for c in classes:
+                self._index.setdefault(c, []).append(i)
+
+        # Packages that only exist implicitly through "within" clauses are
+        # created when loading any of the files inside them.
+        implicit_packages = OrderedDict()
+        for i, classes in enumerate(self._file_classes):
+            for c in classes:
+                for j in range(1, len(c)):
+                    if c[:j] not in self._index:
+                        implicit_packages.setdefault(c[:j], []).append(i)
+
+        for c, files in implicit_packages.items():
+            self._index[c] = files
+            for i in files:
+                self._file_classes[i].append(c)
+
+    @classmethod
+    def from_folders(cls, folders: Iterable[str], cache_folder: str = None, workers: int = 1,
+                     build_parse_tree: bool = True) -> 'LibraryLoader':
+        file_names = []
+        for folder in folders:
+            for root, dir, files in os.walk(folder, followlinks=True):
+                for item in fnmatch.filter(files, "*.mo"):
+                    file_names.append(os.path.join(root, item))
+        return cls(file_names, cache_folder, workers, build_parse_tree)
+
+    @property
+    def loaded_files(self) -> List[str]:
+        """
+        The files that have been parsed so far, in the order they were found.
+        """
+        return [self.file_names[i] for i in sorted(self._loaded)]
+
+    def create_tree(self) -> ast.Tree:
+        """
+        Create an empty tree that loads its classes from this library.
+        """
+        self.tree = ast.Tree()
+        self.tree.class_loader = self
+        return self.tree
+
+    def __call__(self, class_name: Tuple[str, ...]) -> bool:
+        """
+        Load the files defining the given fully qualified class.
+
+        :param class_name: tuple of names of the class, e.g. ('Package', 'Model')
+        :return: True if any file was loaded, False otherwise
+        """
+        if class_name not in self._index:
+            return False
+
+        # Make sure the enclosing packages are loaded first, such that nested
+        # files are merged into them.
+        loaded = False
+        for i in range(1, len(class_name)):
+            loaded |= self(class_name[:i])
+
+        # Files defining the same class overwrite/extend each other. To end up
+        # with the same classes as when loading all files in order, we load
+        # all files that share a class with each other in one go.
+        to_load = set()
+        pending = list(self._index[class_name])
+        while pending:
+            i = pending.pop()
+            if i in to_load or i in self._loaded:
+                continue
+            to_load.add(i)
+            for c in self._file_classes[i]:
+                pending.extend(self._index[c])
+
+        if not to_load:
+            return loaded
+
+        # Importing the parser is slow, so we only do so when we actually
+        # have to parse something.
+        from . import parser
+
+        file_names = [self.file_names[i] for i in sorted(to_load)]
+        for file_name in file_names:
+            logger.info("Loading {} for class {}".format(file_name, '.'.join(class_name)))
+
+        file_tree = parser.parse_files(file_names, self.cache_folder, self.workers, self.build_parse_tree)
+        self._loaded |= to_load
+
+        if file_tree is not None:
+            self.tree.extend(file_tree)
+
+        return True
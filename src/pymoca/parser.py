@@ -6,11 +6,23 @@ from __future__ import print_function, absolute_import, division, unicode_litera
 
 import antlr4
 import antlr4.Parser
-from typing import Dict
+from antlr4.atn.PredictionMode import PredictionMode
+from antlr4.error.ErrorListener import ConsoleErrorListener
+from antlr4.error.ErrorStrategy import BailErrorStrategy, DefaultErrorStrategy
+from antlr4.error.Errors import ParseCancellationException
+from typing import Dict, Iterable
 from collections import deque, OrderedDict
+import concurrent.futures
 import copy
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
 
 from . import ast
+from . import __version__
 # noinspection PyUnresolvedReferences,PyUnresolvedReferences
 from .generated.ModelicaLexer import ModelicaLexer
 # noinspection PyUnresolvedReferences,PyUnresolvedReferences
@@ -19,6 +31,8 @@ from .generated.ModelicaListener import ModelicaListener
 from .generated.ModelicaParser import ModelicaParser
 
 
+logger = logging.getLogger("pymoca")
+
 # TODO
 #  - Named function arguments (note that either all have to be named, or none)
 #  - Make sure slice indices (eventually) evaluate to integers
@@ -648,7 +662,8 @@ class ASTListener(ModelicaListener):
         # of the symbols. Therefore, we need to keep the component clause's
         # type, and all its symbols' types, pointing at the same empty
         # (ComponentRef) object until we can fill it.
-        clause.type.__dict__.update(self.ast[ctx.type_specifier()].__dict__)
+        type_specifier = self.ast[ctx.type_specifier()]
+        clause.type.set_args(**{key: getattr(type_specifier, key) for key in type_specifier.fields()})
         if ctx.array_subscripts() is not None:
             clause.dimensions = [self.ast[ctx.array_subscripts()]]
             for sym in self.comp_clause.symbol_list:
@@ -666,7 +681,8 @@ class ASTListener(ModelicaListener):
 
     def exitComponent_clause1(self, ctx: ModelicaParser.Component_clause1Context):
         clause = self.ast[ctx]
-        clause.type.__dict__.update(self.ast[ctx.type_specifier()].__dict__)
+        type_specifier = self.ast[ctx.type_specifier()]
+        clause.type.set_args(**{key: getattr(type_specifier, key) for key in type_specifier.fields()})
 
         for sym in self.comp_clause.symbol_list[1:]:
             s = self.class_node.symbols[sym.name]
@@ -814,15 +830,252 @@ def file_to_tree(f: ModelicaFile) -> ast.Tree:
 
     return root
 
-def parse(text):
+class _BailErrorStrategy(BailErrorStrategy):
+    """
+    Bail error strategy that also detaches the parse listeners, such that
+    they are not notified of the rules that are exited while unwinding.
+    """
+
+    def recover(self, recognizer, e):
+        recognizer.removeParseListeners()
+        super().recover(recognizer, e)
+
+    def recoverInline(self, recognizer):
+        recognizer.removeParseListeners()
+        return super().recoverInline(recognizer)
+
+
+# noinspection PyPep8Naming
+class ASTParseListener(antlr4.ParseTreeListener):
+    """
+    Drives an ASTListener from the parse events of the parser, instead of by
+    walking the complete parse tree afterwards.
+
+    Parse listeners are notified on entering a rule, before any of its
+    children are parsed. Some enter handlers of the ASTListener inspect the
+    first tokens or child rules however, so enter events are delayed until
+    the first child rule is entered, or, for the rules in DELAYED_ENTER,
+    until the given child rule has been parsed.
+
+    Once an element, equation, statement or constraint has been converted,
+    its parse tree is discarded, so the complete parse tree of a file is never
+    held in memory.
+    """
+
+    DELAYED_ENTER = {
+        ModelicaParser.RULE_class_definition: ModelicaParser.RULE_class_prefixes,
+        ModelicaParser.RULE_component_clause: ModelicaParser.RULE_type_prefix,
+        ModelicaParser.RULE_component_clause1: ModelicaParser.RULE_type_prefix,
+    }
+
+    DISCARD_RULES = {
+        ModelicaParser.RULE_element,
+        ModelicaParser.RULE_equation,
+        ModelicaParser.RULE_statement,
+        ModelicaParser.RULE_constraint,
+    }
+
+    def __init__(self, parser: ModelicaParser, listener: ASTListener):
+        self.parser = parser
+        self.listener = listener
+        # Stack of [context, entered] of the rules currently being parsed
+        self._rules = []
+
+    def _enter(self, rule):
+        ctx, entered = rule
+        if not entered:
+            rule[1] = True
+            ctx.enterRule(self.listener)
+
+    def enterEveryRule(self, ctx):
+        if self._rules:
+            # The parent context may have been replaced by one for a labeled
+            # alternative since it was entered.
+            parent = self._rules[-1]
+            parent[0] = ctx.parentCtx
+            if parent[0].getRuleIndex() not in self.DELAYED_ENTER:
+                self._handle(self._enter, parent)
+        self._rules.append([ctx, False])
+
+    def exitEveryRule(self, ctx):
+        rule = self._rules.pop()
+        rule[0] = ctx
+        self._handle(self._enter, rule)
+        self._handle(ctx.exitRule, self.listener)
+
+        if self._rules:
+            parent = self._rules[-1]
+            if self.DELAYED_ENTER.get(parent[0].getRuleIndex()) == ctx.getRuleIndex():
+                self._handle(self._enter, parent)
+
+        if ctx.getRuleIndex() in self.DISCARD_RULES:
+            self._discard_children(ctx)
+
+    def _handle(self, f, arg):
+        try:
+            f(arg)
+        except Exception:
+            # The rules being parsed are still exited while the exception
+            # propagates, but their contexts are incomplete.
+            self.parser.removeParseListener(self)
+            raise
+
+    def _discard_children(self, ctx):
+        stack = list(ctx.children or [])
+        while stack:
+            c = stack.pop()
+            self.listener.ast.pop(c, None)
+            if isinstance(c, antlr4.ParserRuleContext) and c.children:
+                stack.extend(c.children)
+        ctx.children = None
+
+
+def parse(text, sll=True, build_parse_tree=True):
+    """
+    Parse Modelica source code into an AST tree.
+
+    :param text: Modelica source code
+    :param sll: First try the faster SLL prediction mode, and only fall back to
+        full LL prediction if that fails. The resulting tree is the same.
+    :param build_parse_tree: Build the complete parse tree before converting
+        it to an AST. If False, the AST is built while parsing, which uses
+        considerably less memory for large files. The resulting tree is the same.
+    :return: AST tree
+    """
     input_stream = antlr4.InputStream(text)
     lexer = ModelicaLexer(input_stream)
     stream = antlr4.CommonTokenStream(lexer)
     parser = ModelicaParser(stream)
-    # parser.buildParseTrees = False
-    parse_tree = parser.stored_definition()
-    ast_listener = ASTListener()
-    parse_walker = antlr4.ParseTreeWalker()
-    parse_walker.walk(ast_listener, parse_tree)
+
+    def stored_definition():
+        if build_parse_tree:
+            return parser.stored_definition(), ASTListener()
+        else:
+            ast_listener = ASTListener()
+            parser.addParseListener(ASTParseListener(parser, ast_listener))
+            try:
+                parser.stored_definition()
+            finally:
+                parser.removeParseListeners()
+            return None, ast_listener
+
+    if sll:
+        # SLL prediction is exact for nearly all input, but it may fail on
+        # some valid (or any invalid) input. We then bail out immediately and
+        # parse again with full LL prediction and the regular error handling.
+        parser._interp.predictionMode = PredictionMode.SLL
+        parser._errHandler = _BailErrorStrategy()
+        parser.removeErrorListeners()
+        try:
+            parse_tree, ast_listener = stored_definition()
+        except ParseCancellationException:
+            parser.reset()
+            parser.addErrorListener(ConsoleErrorListener.INSTANCE)
+            parser._errHandler = DefaultErrorStrategy()
+            parser._interp.predictionMode = PredictionMode.LL
+            parse_tree, ast_listener = stored_definition()
+    else:
+        parse_tree, ast_listener = stored_definition()
+
+    if parse_tree is not None:
+        parse_walker = antlr4.ParseTreeWalker()
+        parse_walker.walk(ast_listener, parse_tree)
     modelica_file = ast_listener.ast_result
     return file_to_tree(modelica_file)
+
+
+def _parse_cache_file_name(text: str, cache_folder: str) -> str:
+    # The AST layout may change between pymoca versions, so the version is
+    # part of the key as well.
+    h = hashlib.sha256()
+    h.update(__version__.encode('utf-8'))
+    h.update(b'\0')
+    h.update(text.encode('utf-8'))
+    return os.path.join(cache_folder, h.hexdigest() + '.pymoca_ast')
+
+
+def parse_file(file_name: str, cache_folder: str = None, build_parse_tree: bool = True) -> ast.Tree:
+    """
+    Parse a Modelica file. If a cache folder is given, the resulting AST is
+    stored in it, keyed by the hash of the file contents and the pymoca
+    version. Subsequent calls for an unchanged file load the AST from the
+    cache instead of parsing it again.
+
+    :param file_name: path to the Modelica file
+    :param cache_folder: folder to store parsed ASTs in, or None to disable caching
+    :param build_parse_tree: see parse()
+    :return: AST of the file
+    """
+    with open(file_name, 'r') as f:
+        text = f.read()
+
+    if cache_folder is None:
+        return parse(text, build_parse_tree=build_parse_tree)
+
+    cache_file = _parse_cache_file_name(text, cache_folder)
+
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # A corrupt or incompatible cache entry is simply regenerated
+        logger.warning("Could not load parse cache for {}: {}".format(file_name, e))
+
+    tree = parse(text, build_parse_tree=build_parse_tree)
+
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partially written cache entry.
+        fd, tmp_file = tempfile.mkstemp(dir=cache_folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(tree, f, protocol=-1)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    except (OSError, RecursionError, pickle.PicklingError) as e:
+        logger.warning("Could not write parse cache for {}: {}".format(file_name, e))
+
+    return tree
+
+
+def parse_files(file_names: Iterable[str], cache_folder: str = None, workers: int = 1,
+                build_parse_tree: bool = True) -> ast.Tree:
+    """
+    Parse multiple Modelica files and merge them into a single tree. Files are
+    merged in the order they are passed in, also when parsing in parallel, so
+    the result does not depend on the number of workers.
+
+    :param file_names: paths to the Modelica files
+    :param cache_folder: parse cache folder, see parse_file()
+    :param workers: number of worker processes. Values of 1 or less parse in
+                    the current process, None uses all available cores.
+    :param build_parse_tree: see parse()
+    :return: merged AST of all files, or None if no files were passed
+    """
+    file_names = list(file_names)
+
+    if (workers is not None and workers <= 1) or len(file_names) <= 1:
+        trees = (parse_file(f, cache_folder, build_parse_tree) for f in file_names)
+        return _merge_trees(file_names, trees)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        trees = executor.map(functools.partial(parse_file, cache_folder=cache_folder,
+                                               build_parse_tree=build_parse_tree), file_names)
+        return _merge_trees(file_names, trees)
+
+
+def _merge_trees(file_names, trees) -> ast.Tree:
+    tree = None
+    for file_name, file_tree in zip(file_names, trees):
+        logger.info("Parsed {}".format(os.path.basename(file_name)))
+        if tree is None:
+            tree = file_tree
+        else:
+            tree.extend(file_tree)
+    return tree
@@ -6,10 +6,11 @@ Tools for tree walking and visiting etc.
 from __future__ import print_function, absolute_import, division, unicode_literals
 
 import copy  # TODO
+import itertools
 import logging
 import sys
 from collections import OrderedDict
-from typing import Union, Iterable
+from typing import Any, Dict, Iterable, Tuple, Union
 import os
 
 import numpy as np
@@ -158,6 +159,20 @@ class TreeListener:
     def exitWhenStatement(self, tree: ast.WhenStatement) -> None: pass
 
 
+# Fields of AST nodes that never contain other nodes, and therefore do not
+# have to be visited when walking the tree. Fields of a node class apply to
+# its subclasses as well.
+LEAF_FIELDS = {
+    ast.Node: {'name', 'comment', 'prefixes', 'redeclare', 'final', 'inner', 'outer', 'encapsulated',
+               'partial', 'initial', 'operand', 'id', 'order', 'visibility', 'left_inner', 'right_inner'},
+    ast.Primary: {'value'},
+    ast.ShortClassDefinition: {'type'},
+    ast.ImportFromClause: {'symbols'},
+    ast.Class: {'type'},
+    ast.Tree: {'class_loader'},
+}
+
+
 class TreeWalker:
     """
     Defines methods for tree walker. Inherit from this to make your own.
@@ -167,16 +182,43 @@ class TreeWalker:
         """
         Skip certain childs in the tree walking. By default it prevents
         endless recursion by skipping references to e.g. parent nodes.
+
+        The result is cached per node type, so it should only depend on the
+        type of the node, and not on its contents.
         :return: True if child needs to be skipped, False otherwise.
         """
         if isinstance(tree, ast.Class) and child_name == 'parent' or \
-                isinstance(tree, ast.ClassModificationArgument) and child_name in ('scope', '__deepcopy__'):
+                isinstance(tree, ast.ClassModificationArgument) and child_name == 'scope':
             return True
         return False
 
     def order_keys(self, keys: Iterable[str]):
         return keys
 
+    def child_fields(self, tree: ast.Node) -> Tuple[str, ...]:
+        """
+        The fields of a node that may contain other nodes, in the order they
+        are walked.
+        :param tree: node
+        :return: tuple of field names
+        """
+        try:
+            cache = self._child_fields
+        except AttributeError:
+            cache = self._child_fields = {}
+
+        node_class = tree.__class__
+        try:
+            return cache[node_class]
+        except KeyError:
+            leaf_fields = set()
+            for c in node_class.__mro__:
+                leaf_fields.update(LEAF_FIELDS.get(c, ()))
+            fields = tuple(k for k in self.order_keys(node_class.fields())
+                           if k not in leaf_fields and not self.skip_child(tree, k))
+            cache[node_class] = fields
+            return fields
+
     def walk(self, listener: TreeListener, tree: ast.Node) -> None:
         """
         Walks an AST tree recursively
@@ -184,19 +226,7 @@ class TreeWalker:
         :param tree:
         :return: None
         """
-        name = tree.__class__.__name__
-        if hasattr(listener, 'enterEvery'):
-            getattr(listener, 'enterEvery')(tree)
-        if hasattr(listener, 'enter' + name):
-            getattr(listener, 'enter' + name)(tree)
-        for child_name in self.order_keys(tree.__dict__.keys()):
-            if self.skip_child(tree, child_name):
-                continue
-            self.handle_walk(listener, tree.__dict__[child_name])
-        if hasattr(listener, 'exitEvery'):
-            getattr(listener, 'exitEvery')(tree)
-        if hasattr(listener, 'exit' + name):
-            getattr(listener, 'exit' + name)(tree)
+        self._walk(listener, tree, {})
 
     def handle_walk(self, listener: TreeListener, tree: Union[ast.Node, dict, list]) -> None:
         """
@@ -205,16 +235,40 @@ class TreeWalker:
         :param tree: the tree to walk
         :return: None
         """
+        self._handle_walk(listener, tree, {})
+
+    @staticmethod
+    def _listener_methods(listener: TreeListener, node_class: type) -> Tuple[tuple, tuple]:
+        name = node_class.__name__
+        enter = tuple(getattr(listener, m) for m in ('enterEvery', 'enter' + name) if hasattr(listener, m))
+        exit = tuple(getattr(listener, m) for m in ('exitEvery', 'exit' + name) if hasattr(listener, m))
+        return enter, exit
+
+    def _walk(self, listener: TreeListener, tree: ast.Node, methods: dict) -> None:
+        # The listener's methods for each node type are looked up only once
+        # per walk, and stored in methods.
+        node_class = tree.__class__
+        try:
+            enter, exit = methods[node_class]
+        except KeyError:
+            enter, exit = methods[node_class] = self._listener_methods(listener, node_class)
+
+        for f in enter:
+            f(tree)
+        for child_name in self.child_fields(tree):
+            self._handle_walk(listener, getattr(tree, child_name), methods)
+        for f in exit:
+            f(tree)
+
+    def _handle_walk(self, listener: TreeListener, tree: Union[ast.Node, dict, list], methods: dict) -> None:
         if isinstance(tree, ast.Node):
-            self.walk(listener, tree)
-        elif isinstance(tree, dict):
-            for k in tree.keys():
-                self.handle_walk(listener, tree[k])
+            self._walk(listener, tree, methods)
         elif isinstance(tree, list):
             for i in range(len(tree)):
-                self.handle_walk(listener, tree[i])
-        else:
-            pass
+                self._handle_walk(listener, tree[i], methods)
+        elif isinstance(tree, dict):
+            for k in tree.keys():
+                self._handle_walk(listener, tree[k], methods)
 
 
 def flatten_extends(orig_class: Union[ast.Class, ast.InstanceClass], modification_environment=None,
@@ -301,8 +355,50 @@ def extends_builtin(class_: ast.Class) -> bool:
     return ret
 
 
+def _modification_key(node):
+    # Hashable, canonical form of a (class) modification, such that two
+    # modifications that lead to the same instance tree have equal keys.
+    if isinstance(node, list):
+        return tuple(_modification_key(x) for x in node)
+    elif isinstance(node, dict):
+        return tuple((k, _modification_key(v)) for k, v in node.items())
+    elif isinstance(node, ast.Class):
+        # Classes (e.g. in redeclarations) are compared by identity
+        return node
+    elif isinstance(node, ast.ClassModificationArgument):
+        # Modifications are applied based on the full reference of their
+        # scope, but redeclarations look up classes in the scope itself.
+        if node.scope is None:
+            scope = None
+        elif node.redeclare:
+            scope = node.scope
+        else:
+            scope = node.scope.full_reference().to_tuple()
+        return (type(node).__name__, scope, node.redeclare, _modification_key(node.value))
+    elif isinstance(node, ast.Node):
+        return (type(node).__name__,) + tuple(
+            _modification_key(getattr(node, key)) for key in node.fields() if key not in ('parent', 'scope'))
+    else:
+        return node
+
+
 def build_instance_tree(orig_class: Union[ast.Class, ast.InstanceClass], modification_environment=None,
-                        parent=None) -> ast.InstanceClass:
+                        parent=None, instance_cache=None) -> ast.InstanceClass:
+    """
+    Build the instance tree of a class, with all extends and modifications
+    applied.
+
+    :param orig_class: class to instantiate
+    :param modification_environment: modifications applied to the class
+    :param parent: parent of the resulting instance
+    :param instance_cache: dictionary of instances of components, keyed on
+        their class and modification. Components with the same class and
+        modification share this entry, and receive a copy of it.
+    :return: the instance tree
+    """
+    if instance_cache is None:
+        instance_cache = {}
+
     extended_orig_class = flatten_extends(orig_class, modification_environment, parent)
 
     # Redeclarations take effect
@@ -319,7 +415,7 @@ def build_instance_tree(orig_class: Union[ast.Class, ast.InstanceClass], modific
             for sym_name, sym in extended_orig_class.symbols.items():
                 if isinstance(sym.type, ast.InstanceClass) and sym.type.name is old_class.name:
                     c = extended_orig_class.classes[argument.name]
-                    sym.type = build_instance_tree(c, sym.class_modification, c.parent)
+                    sym.type = build_instance_tree(c, sym.class_modification, c.parent, instance_cache)
         elif isinstance(argument, ast.ComponentClause):
             # Redeclaration of symbols
             # TODO: Do we need to handle scoping of redeclarations of symbols?
@@ -356,7 +452,8 @@ def build_instance_tree(orig_class: Union[ast.Class, ast.InstanceClass], modific
                 for arg in elem_class_mod.arguments:
                     sub_class_modification.arguments.append(arg)
 
-        extended_orig_class.classes[class_name] = build_instance_tree(c, sub_class_modification, extended_orig_class)
+        extended_orig_class.classes[class_name] = build_instance_tree(
+            c, sub_class_modification, extended_orig_class, instance_cache)
 
     # Check that all symbol modifications to be applied on this class exist
     for arg in extended_orig_class.modification_environment.arguments:
@@ -372,7 +469,8 @@ def build_instance_tree(orig_class: Union[ast.Class, ast.InstanceClass], modific
 
         try:
             if not isinstance(sym.type, ast.InstanceClass):
-                c = extended_orig_class.find_class(sym.type)
+                # The class is only copied when its instance is not cached
+                c = extended_orig_class.find_class(sym.type, copy=False)
             else:
                 c = sym.type
         except ast.FoundElementaryClassError:
@@ -466,7 +564,22 @@ def build_instance_tree(orig_class: Union[ast.Class, ast.InstanceClass], modific
                     arg.scope = extended_orig_class
 
             try:
-                sym.type = build_instance_tree(c, sym.class_modification, c.parent)
+                if isinstance(sym.type, ast.InstanceClass):
+                    sym.type = build_instance_tree(c, sym.class_modification, c.parent, instance_cache)
+                else:
+                    # Components of the same class and with the same
+                    # modification have the same instance tree, which we
+                    # therefore only build once.
+                    key = (c, _modification_key(sym.class_modification))
+                    try:
+                        instance = instance_cache[key]
+                    except KeyError:
+                        instance = build_instance_tree(
+                            c.copy_including_children(), sym.class_modification, c.parent, instance_cache)
+                        instance_cache[key] = instance.copy_including_children()
+                    else:
+                        instance = instance.copy_including_children()
+                    sym.type = instance
             except Exception as e:
                 error_sym = str(orig_class.full_reference()) + "." + sym_name
                 raise type(e)('Processing failed for symbol "{}"'.format(error_sym)) from e
@@ -479,8 +592,10 @@ def build_instance_tree(orig_class: Union[ast.Class, ast.InstanceClass], modific
     return extended_orig_class
 
 
-def flatten_symbols(class_: ast.InstanceClass, instance_name='') -> ast.Class:
-    # Recursive symbol flattening
+def flatten_symbols(class_: ast.InstanceClass, instance_name='', component_cache=None) -> ast.Class:
+    # Recursive symbol flattening. The flattened non-elementary symbols of
+    # class_ are stored in the optional component_cache, keyed on their name.
+    # Symbols that are already in there are not flattened again.
 
     flat_class = ast.Class(
         name=class_.name,
@@ -534,7 +649,14 @@ def flatten_symbols(class_: ast.InstanceClass, instance_name='') -> ast.Class:
             continue
         else:
             # recursively call flatten on the contained class
-            flat_sub_class = flatten_symbols(sym.type, flat_sym.name)
+            cache_entry = None
+            if component_cache is not None and flat_sym.name in component_cache:
+                flat_sub_class, connector_type = copy.deepcopy(component_cache[flat_sym.name])
+            else:
+                flat_sub_class = flatten_symbols(sym.type, flat_sym.name)
+                connector_type = None
+                if component_cache is not None:
+                    cache_entry = copy.deepcopy(flat_sub_class)
 
             # carry class dimensions over to symbols
             for flat_class_symbol in flat_sub_class.symbols.values():
@@ -556,12 +678,17 @@ def flatten_symbols(class_: ast.InstanceClass, instance_name='') -> ast.Class:
                 # We flatten sym.type here to avoid later deepcopy()
                 # statements copying the entire instance tree due to
                 # references to parent and/or root.
-                flat_sym.__connector_type = flatten_class(sym.type)
+                if connector_type is None:
+                    connector_type = flatten_class(sym.type)
+                flat_sym.connector_type = connector_type
                 flat_class.symbols[flat_sym.name] = flat_sym
 
                 # TODO: Do we need the symbol type after this?
                 sym.type = sym.type.name
 
+            if cache_entry is not None:
+                component_cache[flat_sym.name] = (cache_entry, copy.deepcopy(connector_type))
+
     # Apply any symbol modifications if the scope of said modification is equal to that of the current class
     apply_symbol_modifications(flat_class, class_)
 
@@ -583,10 +710,10 @@ def flatten_symbols(class_: ast.InstanceClass, instance_name='') -> ast.Class:
         flat_class.equations.append(flat_equation)
         if isinstance(flat_equation, ast.ConnectClause):
             # following section 9.2 of the Modelica spec, we treat 'inner' and 'outer' connectors differently.
-            if not hasattr(flat_equation, '__left_inner'):
-                flat_equation.__left_inner = len(equation.left.child) > 0
-            if not hasattr(flat_equation, '__right_inner'):
-                flat_equation.__right_inner = len(equation.right.child) > 0
+            if flat_equation.left_inner is None:
+                flat_equation.left_inner = len(equation.left.child) > 0
+            if flat_equation.right_inner is None:
+                flat_equation.right_inner = len(equation.right.child) > 0
 
     # for all constraints in original class
     for constraint in class_.constraints:
@@ -868,13 +995,13 @@ def apply_constant_references(class_: ast.InstanceClass) -> None:
     w.walk(ConstantReferenceApplier(class_), class_)
 
 
-def flatten_class(orig_class: ast.Class) -> ast.Class:
+def flatten_class(orig_class: ast.Class, instance_cache=None, component_cache=None) -> ast.Class:
     # First we build a tree of the to-be-flattened class, with all symbol
     # types expanded to classes as well. Modifications are shifted/passed
     # along to child classes.
     # Note that no element modifications are applied (e.g of values, nominals,
     # etc), and no symbol flattening is performed.
-    instance_tree = build_instance_tree(orig_class, parent=orig_class.parent)
+    instance_tree = build_instance_tree(orig_class, parent=orig_class.parent, instance_cache=instance_cache)
 
     # At this point:
     # 1. All redeclarations have been handled.
@@ -888,11 +1015,92 @@ def flatten_class(orig_class: ast.Class) -> ast.Class:
     apply_constant_references(instance_tree)
 
     # Finally we flatten all symbols and apply modifications.
-    flat_class = flatten_symbols(instance_tree)
+    flat_class = flatten_symbols(instance_tree, component_cache=component_cache)
 
     return flat_class
 
 
+class ConnectionSets:
+    """
+    Disjoint sets of connected variables, e.g. for the flow variables of
+    connectors. The members of each set are kept in the order they were
+    connected in, as a linked list.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._next = {}
+        self._sets = {}  # type: Dict[Any, list]  # root -> [head, tail, size]
+
+        # Value of each connected variable, in order of first connection
+        self.values = OrderedDict()
+
+    def _add(self, key, value) -> bool:
+        self.values[key] = value
+        if key in self._parent:
+            return False
+        self._parent[key] = key
+        self._next[key] = None
+        self._sets[key] = [key, key, 1]
+        return True
+
+    def find(self, key):
+        """
+        Find the representative member of the set of a variable.
+        """
+        parent = self._parent
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def _union(self, a, b):
+        # Merge the set of b into that of a, keeping the members of a first
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        set_a, set_b = self._sets.pop(a), self._sets.pop(b)
+        self._next[set_a[1]] = set_b[0]
+        merged = [set_a[0], set_b[1], set_a[2] + set_b[2]]
+        if set_a[2] < set_b[2]:
+            a, b = b, a
+        self._parent[b] = a
+        self._sets[a] = merged
+
+    def connect(self, left, left_value, right, right_value) -> None:
+        """
+        Connect two variables. The resulting set contains the members of the
+        set of left, those of the set of right, and then the variables that
+        were not connected before.
+        """
+        left_new = self._add(left, left_value)
+        right_new = self._add(right, right_value)
+
+        parts = [x for x, new in ((left, left_new), (right, right_new)) if not new]
+        parts += [x for x, new in ((left, left_new), (right, right_new)) if new]
+        for x in parts[1:]:
+            self._union(parts[0], x)
+
+    def __iter__(self):
+        """
+        Iterate over the sets, in order of their first connected member. Each
+        set is a list of the values of its members.
+        """
+        seen = set()
+        for key in self.values:
+            root = self.find(key)
+            if root in seen:
+                continue
+            seen.add(root)
+
+            members = []
+            member = self._sets[root][0]
+            while member is not None:
+                members.append(self.values[member])
+                member = self._next[member]
+            yield members
+
+
 def expand_connectors(node: ast.Class) -> None:
     # keep track of which flow variables have been connected to, and which ones haven't
     disconnected_flow_variables = OrderedDict()
@@ -900,9 +1108,13 @@ def expand_connectors(node: ast.Class) -> None:
         if 'flow' in sym.prefixes:
             disconnected_flow_variables[sym.name] = sym
 
+    # Connectors of the same type are flattened only once. The symbols of
+    # their flattened classes are the same, and identify the type.
+    flat_connector_classes = {}
+
     # add flow equations
     # for all equations in original class
-    flow_connections = OrderedDict()
+    flow_connections = ConnectionSets()
     orig_equations = node.equations[:]
     node.equations = []
     for equation in orig_equations:
@@ -919,12 +1131,12 @@ def expand_connectors(node: ast.Class) -> None:
             sym_right = node.symbols[equation.right.name]
 
             try:
-                class_left = getattr(sym_left, '__connector_type', None)
+                class_left = sym_left.connector_type
                 if class_left is None:
                     # We may be connecting classes which are not connectors, such as Reals.
                     class_left = node.find_class(sym_left.type)
                 # noinspection PyUnusedLocal
-                class_right = getattr(sym_right, '__connector_type', None)
+                class_right = sym_right.connector_type
                 if class_right is None:
                     # We may be connecting classes which are not connectors, such as Reals.
                     class_right = node.find_class(sym_right.type)
@@ -939,7 +1151,14 @@ def expand_connectors(node: ast.Class) -> None:
             else:
                 # TODO: Add check about matching inputs and outputs
 
-                flat_class_left = flatten_class(class_left)
+                if sym_left.connector_type is not None:
+                    key = tuple((x.name, tuple(x.prefixes), repr(x.type)) for x in class_left.symbols.values())
+                    try:
+                        flat_class_left = flat_connector_classes[key]
+                    except KeyError:
+                        flat_class_left = flat_connector_classes[key] = flatten_class(class_left)
+                else:
+                    flat_class_left = flatten_class(class_left)
 
                 for connector_variable in flat_class_left.symbols.values():
                     left_name = equation.left.name + CLASS_SEPARATOR + connector_variable.name
@@ -958,22 +1177,14 @@ def expand_connectors(node: ast.Class) -> None:
                         left_key = (left_name,
                                     tuple(i.value for index_array in left.indices
                                           for i in index_array if i is not None),
-                                    equation.__left_inner)
+                                    equation.left_inner)
                         right_key = (right_name,
                                      tuple(i.value for index_array in right.indices
                                            for i in index_array if i is not None),
-                                     equation.__right_inner)
-
-                        left_connected_variables = flow_connections.get(left_key, OrderedDict())
-                        right_connected_variables = flow_connections.get(right_key, OrderedDict())
-
-                        left_connected_variables.update(right_connected_variables)
-                        connected_variables = left_connected_variables
-                        connected_variables[left_key] = (left, equation.__left_inner)
-                        connected_variables[right_key] = (right, equation.__right_inner)
+                                     equation.right_inner)
 
-                        for connected_variable in connected_variables:
-                            flow_connections[connected_variable] = connected_variables
+                        flow_connections.connect(left_key, (left, equation.left_inner),
+                                                 right_key, (right, equation.right_inner))
 
                         # TODO When dealing with an array of connectors, we can lose
                         # disconnected flow variables in this way.  We don't initialize
@@ -990,22 +1201,18 @@ def expand_connectors(node: ast.Class) -> None:
         else:
             node.equations.append(equation)
 
-    processed = []  # OrderedDict is not hashable, so we cannot use sets.
-    for connected_variables in flow_connections.values():
-        if connected_variables not in processed:
-            operand_specs = list(connected_variables.values())
-            if np.all([not op_spec[1] for op_spec in operand_specs]):
-                # All outer variables. Don't include unnecessary minus expressions.
-                operands = [op_spec[0] for op_spec in operand_specs]
-            else:
-                operands = [op_spec[0] if op_spec[1] else ast.Expression(operator='-', operands=[op_spec[0]]) for
-                            op_spec in operand_specs]
-            expr = operands[-1]
-            for op in reversed(operands[:-1]):
-                expr = ast.Expression(operator='+', operands=[op, expr])
-            connect_equation = ast.Equation(left=expr, right=ast.Primary(value=0))
-            node.equations.append(connect_equation)
-            processed.append(connected_variables)
+    for operand_specs in flow_connections:
+        if np.all([not op_spec[1] for op_spec in operand_specs]):
+            # All outer variables. Don't include unnecessary minus expressions.
+            operands = [op_spec[0] for op_spec in operand_specs]
+        else:
+            operands = [op_spec[0] if op_spec[1] else ast.Expression(operator='-', operands=[op_spec[0]]) for
+                        op_spec in operand_specs]
+        expr = operands[-1]
+        for op in reversed(operands[:-1]):
+            expr = ast.Expression(operator='+', operands=[op, expr])
+        connect_equation = ast.Equation(left=expr, right=ast.Primary(value=0))
+        node.equations.append(connect_equation)
 
     # disconnected flow variables default to 0
     for sym in disconnected_flow_variables.values():
@@ -1014,7 +1221,7 @@ def expand_connectors(node: ast.Class) -> None:
 
     # strip connector symbols
     for i, sym in list(node.symbols.items()):
-        if hasattr(sym, '__connector_type'):
+        if sym.connector_type is not None:
             del node.symbols[i]
 
 
@@ -1098,6 +1305,10 @@ def flatten(root: ast.Tree, class_name: ast.ComponentRef) -> ast.Class:
 
     flat_class = flatten_class(orig_class)
 
+    return _flat_tree(orig_class.name, flat_class)
+
+
+def _flat_tree(class_name: str, flat_class: ast.Class) -> ast.Tree:
     # expand connectors
     expand_connectors(flat_class)
 
@@ -1111,7 +1322,7 @@ def flatten(root: ast.Tree, class_name: ast.ComponentRef) -> ast.Class:
 
     # Put class in root
     root = ast.Tree()
-    root.classes[orig_class.name] = flat_class
+    root.classes[class_name] = flat_class
 
     # pull functions to the top level,
     # putting them prior to the model class so that they are visited
@@ -1122,3 +1333,195 @@ def flatten(root: ast.Tree, class_name: ast.ComponentRef) -> ast.Class:
     root.classes = functions_and_classes
 
     return root
+
+
+class DependencyCollector(TreeListener):
+    """
+    Collects the full references of all classes that are referred to in a
+    (part of a) class, and of the classes nested in it.
+    """
+
+    def __init__(self, scope: ast.Class = None):
+        self.classes = [scope] if scope is not None else []
+        self.dependencies = set()
+        self.depth = 0
+        super().__init__()
+
+    def enterClass(self, tree: ast.Class):
+        self.classes.append(tree)
+        self.dependencies.add(tree.full_reference().to_tuple())
+
+    def exitClass(self, tree: ast.Class):
+        self.classes.pop()
+
+    def enterComponentRef(self, tree: ast.ComponentRef):
+        self.depth += 1
+        if self.depth > 1:
+            return
+
+        # The reference can also be to e.g. a constant inside a class, so we
+        # look for the longest prefix that is a class.
+        names = tree.to_tuple()
+        for i in range(len(names), 0, -1):
+            try:
+                c = self.classes[-1].find_class(ast.ComponentRef.from_tuple(names[:i]), copy=False)
+            except (ast.ClassNotFoundError, ast.FoundElementaryClassError):
+                continue
+            self.dependencies.add(c.full_reference().to_tuple())
+            break
+
+    def exitComponentRef(self, tree: ast.ComponentRef):
+        self.depth -= 1
+
+
+def _key_items(key):
+    # All items in a (nested) instance cache key
+    if isinstance(key, tuple):
+        for x in key:
+            yield from _key_items(x)
+    else:
+        yield key
+
+
+class FlatteningSession:
+    """
+    Flattens a class like flatten() does, but keeps the instance trees and the
+    flattened (top-level) components of the class around. When classes in the
+    tree are replaced with update(), flattening again only recomputes the
+    components that depend on the replaced classes.
+    """
+
+    def __init__(self, root: ast.Tree, class_name: ast.ComponentRef):
+        self.root = root
+        self.class_name = class_name
+
+        self._instance_cache = {}
+        self._component_cache = {}
+
+    def flatten(self) -> ast.Tree:
+        """
+        Flatten the class, reusing the components that did not change since
+        the previous call.
+
+        :return: Tree containing the flattened class
+        """
+        # Flattening modifies the top-level class, so we work on a copy. That
+        # way, we can still determine what its components depend on.
+        orig_class = self.root.find_class(self.class_name)
+
+        flat_class = flatten_class(orig_class, self._instance_cache, self._component_cache)
+
+        # Instances of nested classes and of redeclared classes are specific
+        # to this instance tree, and will not be looked up again.
+        for key in list(self._instance_cache.keys()):
+            if isinstance(key[0], ast.InstanceClass) or any(isinstance(x, ast.Node) for x in _key_items(key[1])):
+                del self._instance_cache[key]
+
+        return _flat_tree(orig_class.name, flat_class)
+
+    def update(self, other: ast.Tree) -> None:
+        """
+        Replace classes in the tree with the (edited) classes in another
+        tree, e.g. the result of parsing a modified file. Components that
+        depend on the replaced classes will be flattened again.
+
+        :param other: Tree with the classes to replace.
+        """
+        # Dependencies are determined on the old tree, as the classes they
+        # refer to are the ones that we are replacing.
+        dependencies = {}
+
+        def class_dependencies(full_reference):
+            pending = [full_reference]
+            result = set()
+            while pending:
+                r = pending.pop()
+                if r in result:
+                    continue
+                result.add(r)
+                if r not in dependencies:
+                    collector = DependencyCollector()
+                    try:
+                        c = self.root
+                        for name in r:
+                            c = c.classes[name]
+                    except KeyError:
+                        pass
+                    else:
+                        TreeWalker().walk(collector, c)
+                    dependencies[r] = collector.dependencies
+                pending.extend(dependencies[r])
+            return result
+
+        orig_class = self.root.find_class(self.class_name, copy=False)
+
+        # The top-level class and the classes it extends
+        top_classes = [orig_class]
+        for c in top_classes:
+            for extends in c.extends:
+                try:
+                    top_classes.append(c.find_class(extends.component, copy=False))
+                except (ast.ClassNotFoundError, ast.FoundElementaryClassError):
+                    pass
+        top_dependencies = set(c.full_reference().to_tuple() for c in top_classes)
+
+        # Components depend on the classes referred to in their declaration,
+        # and in the modifications of the extends clauses of the top-level
+        # class.
+        extends_collector = DependencyCollector()
+        for c in top_classes:
+            extends_collector.classes = [c]
+            TreeWalker().handle_walk(extends_collector, c.extends)
+
+        component_dependencies = {}
+        for name in self._component_cache:
+            collector = DependencyCollector()
+            collector.dependencies = set(extends_collector.dependencies)
+            for c in top_classes:
+                if name in c.symbols:
+                    collector.classes = [c]
+                    TreeWalker().walk(collector, c.symbols[name])
+            component_dependencies[name] = set()
+            for r in collector.dependencies:
+                component_dependencies[name] |= class_dependencies(r)
+
+        instance_dependencies = {key: class_dependencies(key[0].full_reference().to_tuple())
+                                 for key in self._instance_cache}
+
+        changed = self.root.extend(other, replace=True)
+
+        replaced = set()
+        replaced_names = set()
+        reset = False
+        scopes = set(r[:i] for r in itertools.chain(top_dependencies, *dependencies.values())
+                     for i in range(len(r) + 1))
+
+        for old, new in changed:
+            full_reference = new.full_reference().to_tuple()
+            if old is None:
+                # Added classes can shadow classes we used before
+                reset |= full_reference[:-1] in scopes
+            else:
+                replaced.add(full_reference)
+
+            classes = [c for c in (old, new) if c is not None]
+            for c in classes:
+                replaced_names.add(c.name)
+                classes.extend(c.classes.values())
+
+        def is_affected(deps):
+            return any(r[:i] in replaced for r in deps for i in range(1, len(r) + 1))
+
+        if reset or is_affected(top_dependencies):
+            self._instance_cache.clear()
+            self._component_cache.clear()
+            return
+
+        for name, deps in component_dependencies.items():
+            if is_affected(deps):
+                del self._component_cache[name]
+
+        # Modifications refer to classes by name, e.g. in redeclarations
+        for key, deps in instance_dependencies.items():
+            if is_affected(deps) or any(x in replaced_names for x in _key_items(key[1]) if isinstance(x, str)):
+                del self._instance_cache[key]
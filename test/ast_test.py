@@ -1,3 +1,5 @@
+import copy
+import pickle
 import unittest
 
 from pymoca import ast
@@ -40,3 +42,53 @@ class TestASTManipulation(unittest.TestCase):
 
         self.ast.remove_equation(e)
         self.assertNotIn(e, self.ast.equations)
+
+    def test_slots(self):
+        s = ast.Symbol(name='TestSymbol')
+        self.assertFalse(hasattr(s, '__dict__'))
+        self.assertIn('name', ast.Symbol.fields())
+        self.assertIn('connector_type', ast.Symbol.fields())
+        self.assertIn('modification_environment', ast.InstanceClass.fields())
+
+        with self.assertRaises(KeyError):
+            ast.Symbol(no_such_field=1)
+
+    def test_shared_defaults(self):
+        s = ast.Symbol(name='TestSymbol')
+        self.assertIs(s.start, ast.Symbol().start)
+        self.assertIsNone(s.start.value)
+
+        with self.assertRaises(AttributeError):
+            s.start.value = 1.0
+
+        # Shared defaults survive copying and pickling
+        self.assertIs(copy.deepcopy(s).start, s.start)
+        self.assertIs(pickle.loads(pickle.dumps(s)).start, s.start)
+
+        s.start = ast.Primary(value=1.0)
+        s_copy = copy.deepcopy(s)
+        self.assertIsNot(s_copy.start, s.start)
+        self.assertEqual(s_copy.start.value, 1.0)
+        self.assertEqual(repr(s_copy), repr(s))
+
+    def test_copy_including_children(self):
+        c = ast.Class(name='TestClass')
+        self.ast.add_class(c)
+        nested = ast.Class(name='NestedClass')
+        c.add_class(nested)
+
+        s = ast.Symbol(name='TestSymbol', type=ast.ComponentRef.from_tuple(('Real',)))
+        c.add_symbol(s)
+        e = ast.Equation(left=ast.ComponentRef.from_tuple(('a',)), right=ast.ComponentRef.from_tuple(('b',)))
+        c.add_equation(e)
+        nested.add_equation(e)
+
+        c_copy = c.copy_including_children()
+
+        # Symbols are copied, equations are shared
+        self.assertIsNot(c_copy.symbols['TestSymbol'], s)
+        self.assertIsNot(c_copy.equations, c.equations)
+        self.assertIs(c_copy.equations[0], e)
+        self.assertIs(c_copy.classes['NestedClass'].equations[0], e)
+        self.assertIs(c_copy.parent, self.ast)
+        self.assertEqual(repr(c_copy), repr(c))
@@ -5,7 +5,12 @@ Modelica parse Tree to AST tree.
 from __future__ import print_function, absolute_import, division, unicode_literals
 
 import os
+import copy
 import glob
+import json
+import pickle
+import shutil
+import tempfile
 import unittest
 import itertools
 
@@ -14,6 +19,7 @@ import numpy as np
 
 import pymoca.backends.casadi.generator as gen_casadi
 from pymoca.backends.casadi.alias_relation import AliasRelation
+from pymoca.backends.casadi.cache_store import CacheStore
 from pymoca.backends.casadi.model import CASADI_ATTRIBUTES, Model, Variable, DelayArgument
 from pymoca.backends.casadi.api import transfer_model, CachedModel
 from pymoca import parser, ast
@@ -942,6 +948,102 @@ class GenCasadiTest(unittest.TestCase):
         self.assert_model_equivalent_numeric(ref_model, cached_model)
         self.assert_model_variables_equivalant(ref_model, cached_model)
 
+    def test_cache_delay_durations(self):
+        # Clear cache
+        db_file = os.path.join(MODEL_DIR, 'DelayDurations.pymoca_cache')
+        try:
+            os.remove(db_file)
+        except FileNotFoundError:
+            pass
+
+        compiler_options = {'cache': True}
+
+        ref_model = transfer_model(MODEL_DIR, 'DelayDurations', compiler_options)
+        self.assertNotIsInstance(ref_model, CachedModel)
+
+        cached_model = transfer_model(MODEL_DIR, 'DelayDurations', compiler_options)
+        self.assertIsInstance(cached_model, CachedModel)
+
+        self.assert_model_equivalent_numeric(ref_model, cached_model)
+        self.assert_model_variables_equivalant(ref_model, cached_model)
+
+        # Durations only depend on the symbols they actually depend on
+        durations = [[{x.name() for x in ca.symvar(ca.MX(a.duration))} for a in m.delay_arguments]
+                     for m in [ref_model, cached_model]]
+        self.assertListEqual(durations[0], durations[1])
+        self.assertListEqual(durations[1], [{'tau1'}, {'tau1', 'tau2'}, set()])
+
+        self.assertIsInstance(cached_model.delay_arguments[2].duration, ca.DM)
+        self.assertEqual(float(cached_model.delay_arguments[2].duration), 3.0)
+
+        # Pickling MX functions is not supported by all CasADi versions
+        with open(db_file, 'rb') as f:
+            db = pickle.load(f)
+        self.assertTrue(db['__delay_durations']['function'].is_a('SXFunction'))
+
+    def test_cache_columnar(self):
+        for model_name in ['Aircraft', 'Delay']:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                compiler_options = {'cache': True, 'columnar_cache': True, 'cache_folder': tmp_dir}
+
+                ref_model = transfer_model(MODEL_DIR, model_name, compiler_options)
+                self.assertNotIsInstance(ref_model, CachedModel)
+
+                cached_model = transfer_model(MODEL_DIR, model_name, compiler_options)
+                self.assertIsInstance(cached_model, CachedModel)
+
+                # Variables are only created when accessed
+                self.assertFalse(set(cached_model._variables) & {'states', 'parameters'})
+
+                self.assert_model_equivalent_numeric(ref_model, cached_model)
+                self.assert_model_variables_equivalant(ref_model, cached_model)
+
+        # Saving again writes a new columns folder, and removes the old one
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shutil.copy(os.path.join(MODEL_DIR, 'Spring.mo'), tmp_dir)
+            model_file = os.path.join(tmp_dir, 'Spring.mo')
+            compiler_options = {'cache': True, 'columnar_cache': True}
+
+            def columns_folders():
+                return [f for f in os.listdir(tmp_dir) if f.endswith('.pymoca_columns')]
+
+            ref_model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertNotIsInstance(ref_model, CachedModel)
+            old_columns_folders = columns_folders()
+            self.assertEqual(len(old_columns_folders), 1)
+
+            mtime = os.path.getmtime(model_file) + 100
+            os.utime(model_file, (mtime, mtime))
+            model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertNotIsInstance(model, CachedModel)
+
+            self.assertEqual(len(columns_folders()), 1)
+            self.assertNotEqual(columns_folders(), old_columns_folders)
+            self.assertFalse([f for f in os.listdir(tmp_dir) if f.startswith('.tmp-')])
+
+            os.utime(model_file, (mtime - 200, mtime - 200))
+            cached_model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+            self.assert_model_variables_equivalant(ref_model, cached_model)
+
+        # Symbolic metadata is the same as that of a pickled cache
+        models = []
+        for columnar_cache in [False, True]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                compiler_options = {'cache': True, 'columnar_cache': columnar_cache, 'cache_folder': tmp_dir}
+                transfer_model(MODEL_DIR, 'ParameterAttributes', compiler_options)
+                models.append(transfer_model(MODEL_DIR, 'ParameterAttributes', compiler_options))
+
+        for vgroup in ["states", "der_states", "alg_states", "inputs", "constants", "parameters"]:
+            for variable_this, variable_that in zip(*[getattr(m, vgroup) for m in models]):
+                self.assertEqual(variable_this.symbol.name(), variable_that.symbol.name())
+                self.assertEqual(variable_this.python_type, variable_that.python_type)
+                for attr in CASADI_ATTRIBUTES:
+                    val_this = getattr(variable_this, attr)
+                    val_that = getattr(variable_that, attr)
+                    self.assertEqual(type(val_this), type(val_that))
+                    self.assertEqual(str(val_this), str(val_that))
+
     def test_codegen(self):
         # Clear cache
         db_file = os.path.join(MODEL_DIR, 'Aircraft.pymoca_cache')
@@ -973,6 +1075,250 @@ class GenCasadiTest(unittest.TestCase):
         self.assert_model_equivalent_numeric(ref_model, cached_model)
         self.assert_model_variables_equivalant(ref_model, cached_model)
 
+    def test_codegen_single_library(self):
+        # Clear cache
+        db_file = os.path.join(MODEL_DIR, 'Delay.pymoca_cache')
+        try:
+            os.remove(db_file)
+        except FileNotFoundError:
+            pass
+
+        for f in glob.glob(os.path.join(MODEL_DIR, "Delay*.so")):
+            os.remove(f)
+
+        # Create model, cache it, and load the cache
+        compiler_options = \
+            {'codegen': True, 'codegen_single_library': True}
+
+        ref_model = transfer_model(MODEL_DIR, 'Delay', compiler_options)
+        self.assertNotIsInstance(ref_model, CachedModel)
+
+        cached_model = transfer_model(MODEL_DIR, 'Delay', compiler_options)
+        self.assertIsInstance(cached_model, CachedModel)
+
+        if os.name == 'posix':
+            self.assertListEqual(glob.glob(os.path.join(MODEL_DIR, "Delay*.so")),
+                                 [os.path.join(MODEL_DIR, "Delay.so")])
+
+        # Compare
+        self.assert_model_equivalent_numeric(ref_model, cached_model)
+        self.assert_model_variables_equivalant(ref_model, cached_model)
+
+    def test_codegen_derivatives(self):
+        # Clear cache
+        db_file = os.path.join(MODEL_DIR, 'Estimator.pymoca_cache')
+        try:
+            os.remove(db_file)
+        except FileNotFoundError:
+            pass
+
+        # Only generate forward derivatives and the full Jacobian
+        compiler_options = \
+            {'codegen': True, 'codegen_derivatives': ['forward', 'jacobian'],
+             'codegen_optimization_level': 0}
+
+        ref_model = transfer_model(MODEL_DIR, 'Estimator', compiler_options)
+        cached_model = transfer_model(MODEL_DIR, 'Estimator', compiler_options)
+        self.assertIsInstance(cached_model, CachedModel)
+
+        f = cached_model.dae_residual_function
+        self.assertEqual(f.forward(1).class_name(), 'External')
+        self.assertEqual(f.jacobian().class_name(), 'External')
+        self.assertNotEqual(f.reverse(1).class_name(), 'External')
+
+        # Compare
+        self.assert_model_equivalent_numeric(ref_model, cached_model)
+
+        with self.assertRaises(ValueError):
+            transfer_model(MODEL_DIR, 'Estimator', {'codegen': True, 'codegen_derivatives': ['hessian_vector']})
+
+        with self.assertRaises(ValueError):
+            transfer_model(MODEL_DIR, 'Estimator', {'codegen': True, 'codegen_optimization_level': 4})
+
+    def test_cache_hash_check(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_folder = os.path.join(tmp_dir, 'a')
+            os.mkdir(model_folder)
+            shutil.copy(os.path.join(MODEL_DIR, 'Spring.mo'), model_folder)
+
+            compiler_options = {'cache': True, 'hash_check': True}
+
+            ref_model = transfer_model(model_folder, 'Spring', compiler_options)
+            self.assertNotIsInstance(ref_model, CachedModel)
+
+            # A newer modification time does not invalidate the cache
+            model_file = os.path.join(model_folder, 'Spring.mo')
+            mtime = os.path.getmtime(model_file) + 100
+            os.utime(model_file, (mtime, mtime))
+
+            cached_model = transfer_model(model_folder, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+            self.assert_model_equivalent_numeric(ref_model, cached_model)
+
+            # Neither does moving the folder elsewhere
+            moved_folder = os.path.join(tmp_dir, 'b')
+            shutil.move(model_folder, moved_folder)
+            model_file = os.path.join(moved_folder, 'Spring.mo')
+
+            cached_model = transfer_model(moved_folder, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+            # Changing the contents does
+            with open(model_file, 'a') as f:
+                f.write('\n// Comment\n')
+
+            model = transfer_model(moved_folder, 'Spring', compiler_options)
+            self.assertNotIsInstance(model, CachedModel)
+
+    def test_cache_hash_check_stats(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shutil.copy(os.path.join(MODEL_DIR, 'Spring.mo'), tmp_dir)
+            model_file = os.path.join(tmp_dir, 'Spring.mo')
+
+            # Recently modified files are always hashed again
+            mtime = os.path.getmtime(model_file) - 100
+            os.utime(model_file, (mtime, mtime))
+
+            compiler_options = {'cache': True, 'hash_check': True}
+
+            ref_model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertNotIsInstance(ref_model, CachedModel)
+
+            # Files with the same size and modification time are not read
+            with open(model_file, 'r') as f:
+                txt = f.read()
+            with open(model_file, 'w') as f:
+                f.write(txt.replace('Spring', 'Sprong'))
+            os.utime(model_file, (mtime, mtime))
+
+            cached_model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+            # Other files are read and hashed again, after which their new
+            # stats are stored in the cache
+            with open(model_file, 'w') as f:
+                f.write(txt)
+            os.utime(model_file, (mtime + 1, mtime + 1))
+
+            cached_model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+            with open(model_file, 'w') as f:
+                f.write(txt.replace('Spring', 'Sprong'))
+            os.utime(model_file, (mtime + 1, mtime + 1))
+
+            cached_model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+            # The same holds for the entries of a cache store
+            store_options = {'cache': True, 'cache_folder': os.path.join(tmp_dir, 'cache')}
+            with open(model_file, 'w') as f:
+                f.write(txt)
+            os.utime(model_file, (mtime, mtime))
+
+            model = transfer_model(tmp_dir, 'Spring', store_options)
+            self.assertNotIsInstance(model, CachedModel)
+
+            os.utime(model_file, (mtime + 1, mtime + 1))
+            cached_model = transfer_model(tmp_dir, 'Spring', store_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+            with open(model_file, 'w') as f:
+                f.write(txt.replace('Spring', 'Sprong'))
+            os.utime(model_file, (mtime + 1, mtime + 1))
+
+            cached_model = transfer_model(tmp_dir, 'Spring', store_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+            with open(model_file, 'w') as f:
+                f.write(txt)
+            with open(model_file, 'a') as f:
+                f.write('\n// Comment\n')
+            os.utime(model_file, (mtime, mtime))
+
+            model = transfer_model(tmp_dir, 'Spring', compiler_options)
+            self.assertNotIsInstance(model, CachedModel)
+
+    def test_cache_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_folder = os.path.join(tmp_dir, 'model')
+            os.mkdir(model_folder)
+            shutil.copy(os.path.join(MODEL_DIR, 'Spring.mo'), model_folder)
+            model_file = os.path.join(model_folder, 'Spring.mo')
+            cache_folder = os.path.join(tmp_dir, 'cache')
+
+            def entries():
+                return [os.path.join(model_key, entry) for model_key in os.listdir(cache_folder)
+                        if model_key != '.lock' for entry in os.listdir(os.path.join(cache_folder, model_key))]
+
+            # Entries for different options are stored next to each other
+            for compiler_options in [{'cache': True}, {'codegen': True}]:
+                compiler_options['cache_folder'] = cache_folder
+
+                ref_model = transfer_model(model_folder, 'Spring', compiler_options)
+                self.assertNotIsInstance(ref_model, CachedModel)
+
+                cached_model = transfer_model(model_folder, 'Spring', compiler_options)
+                self.assertIsInstance(cached_model, CachedModel)
+                self.assert_model_equivalent_numeric(ref_model, cached_model)
+
+            self.assertEqual(len(entries()), 2)
+            self.assertListEqual(os.listdir(model_folder), ['Spring.mo'])
+
+            # Saving an existing entry again keeps it
+            store = CacheStore(cache_folder)
+            store.save(model_folder, 'Spring', ref_model, compiler_options)
+            self.assertEqual(len(entries()), 2)
+
+            # A change of the sources results in a new entry. With room for
+            # two codegen entries, the least recently used entry (that of
+            # the 'cache' option) is evicted.
+            with open(model_file, 'a') as f:
+                f.write('\n// Comment\n')
+
+            codegen_entry = max(entries(), key=lambda e: os.path.getmtime(os.path.join(cache_folder, e)))
+            codegen_size = sum(os.path.getsize(os.path.join(root, f))
+                               for root, dirs, files in os.walk(os.path.join(cache_folder, codegen_entry))
+                               for f in files)
+            compiler_options['cache_size_limit'] = 2 * codegen_size + 1000
+
+            model = transfer_model(model_folder, 'Spring', compiler_options)
+            self.assertNotIsInstance(model, CachedModel)
+
+            new_entries = entries()
+            self.assertEqual(len(new_entries), 2)
+            self.assertIn(codegen_entry, new_entries)
+
+            cached_model = transfer_model(model_folder, 'Spring', compiler_options)
+            self.assertIsInstance(cached_model, CachedModel)
+
+    def test_codegen_split(self):
+        # Clear cache
+        db_file = os.path.join(MODEL_DIR, 'Spring.pymoca_cache')
+        try:
+            os.remove(db_file)
+        except FileNotFoundError:
+            pass
+
+        # Compile the translation units of all libraries in parallel
+        compiler_options = \
+            {'codegen': True, 'codegen_split': True, 'codegen_workers': 4}
+
+        ref_model = transfer_model(MODEL_DIR, 'Spring', compiler_options)
+        self.assertNotIsInstance(ref_model, CachedModel)
+
+        # The number of workers does not invalidate the cache
+        compiler_options['codegen_workers'] = 1
+        cached_model = transfer_model(MODEL_DIR, 'Spring', compiler_options)
+        self.assertIsInstance(cached_model, CachedModel)
+
+        # No intermediate files are left behind
+        self.assertListEqual(glob.glob(os.path.join(MODEL_DIR, "Spring*.c")), [])
+
+        # Compare
+        self.assert_model_equivalent_numeric(ref_model, cached_model)
+        self.assert_model_variables_equivalant(ref_model, cached_model)
+
     def test_simplify_replace_constant_values(self):
         # Create model, cache it, and load the cache
         compiler_options = \
@@ -1479,6 +1825,116 @@ class GenCasadiTest(unittest.TestCase):
 
         self.assert_model_equivalent_numeric(casadi_model, ref_model)
 
+    def test_incidence_alias_detection(self):
+        txt = """
+            model IncidenceAlias
+              Real x;
+              Real y;
+              Real z;
+              Real w;
+            equation
+              der(x) = x;
+              2 * y = 2 * x;
+              0 = y + z;
+              w = sin(z) * w;
+            end IncidenceAlias;
+        """
+
+        ast_tree = parser.parse(txt)
+        casadi_model = gen_casadi.generate(ast_tree, 'IncidenceAlias')
+        casadi_model.simplify({'detect_aliases': True, 'incidence_alias_detection': True})
+
+        x = casadi_model.states[0]
+        self.assertSetEqual(x.aliases, {'y', '-z'})
+        self.assertEqual([v.symbol.name() for v in casadi_model.alg_states], ['w'])
+        self.assertEqual(len(casadi_model.equations), 2)
+
+    def test_simplify_replace_parameter_expressions_chain(self):
+        # Parameters defined in reverse order of their dependencies
+        n = 50
+        lines = ["model ParameterChain", "  Real x;", "  parameter Real p0 = 1;"]
+        for i in range(n, 0, -1):
+            lines.append("  parameter Real p{} = 2 * p{};".format(i, i - 1))
+        lines += ["equation", "  der(x) = p{} * x;".format(n), "end ParameterChain;"]
+
+        ast_tree = parser.parse("\n".join(lines))
+        casadi_model = gen_casadi.generate(ast_tree, 'ParameterChain')
+        casadi_model.simplify({'replace_parameter_expressions': True})
+
+        self.assertEqual([p.symbol.name() for p in casadi_model.parameters], ['p0'])
+
+        x = casadi_model.states[0].symbol
+        der_x = casadi_model.der_states[0].symbol
+        p0 = casadi_model.parameters[0].symbol
+        f = ca.Function('f', [x, der_x, p0], casadi_model.equations)
+        self.assertAlmostEqual(float(f(1.0, 0.0, 1.0)), -2.0 ** n)
+
+        # Cycles cannot be resolved
+        txt = """
+            model ParameterCycle
+              Real x;
+              parameter Real p1 = p2 + 1;
+              parameter Real p2 = 2 * p1;
+            equation
+              der(x) = p1 * x;
+            end ParameterCycle;
+        """
+
+        ast_tree = parser.parse(txt)
+        casadi_model = gen_casadi.generate(ast_tree, 'ParameterCycle')
+        with self.assertRaisesRegex(Exception, "Cyclic dependency"):
+            casadi_model.simplify({'replace_parameter_expressions': True})
+
+    def test_simplification_report(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_file = os.path.join(tmp_dir, 'report.json')
+
+            compiler_options = \
+                {'replace_parameter_expressions': True,
+                 'detect_aliases': True,
+                 'simplification_report_file': report_file}
+
+            casadi_model = transfer_model(MODEL_DIR, 'Simplify', compiler_options)
+
+            report = casadi_model.simplification_report
+            self.assertListEqual([p.name for p in report.passes], ['replace_parameter_expressions', 'detect_aliases'])
+            self.assertEqual(report.iterations, 1)
+
+            replace_parameters, detect_aliases = report.passes
+            self.assertLess(replace_parameters.after['parameters'], replace_parameters.before['parameters'])
+            self.assertLess(detect_aliases.after['equations'], detect_aliases.before['equations'])
+            self.assertEqual(detect_aliases.after['equations'], len(casadi_model.equations))
+            self.assertGreaterEqual(detect_aliases.wall_time, 0.0)
+
+            with open(report_file, 'r') as f:
+                self.assertDictEqual(json.load(f), report.to_dict())
+
+        # Without the option there is no report
+        casadi_model = transfer_model(MODEL_DIR, 'Simplify', {'detect_aliases': True})
+        self.assertIsNone(casadi_model.simplification_report)
+
+    @unittest.skipIf(not hasattr(ca, 'cse'), "CasADi version does not support cse")
+    def test_common_subexpression_elimination(self):
+        txt = """
+            model CommonSubexpression
+              Real x;
+              Real y;
+              Real z;
+            equation
+              der(x) = -x;
+              y = sin(x) * cos(x) + 1;
+              z = sin(x) * cos(x) + 2;
+            end CommonSubexpression;
+        """
+
+        ast_tree = parser.parse(txt)
+        ref_model = gen_casadi.generate(ast_tree, 'CommonSubexpression')
+        casadi_model = gen_casadi.generate(ast_tree, 'CommonSubexpression')
+        casadi_model.simplify({'common_subexpression_elimination': True})
+
+        self.assertLess(casadi_model.dae_residual_function.n_nodes(), ref_model.dae_residual_function.n_nodes())
+        self.assert_model_equivalent_numeric(casadi_model, ref_model)
+
     def test_simplify_expand_vectors(self):
         # Create model, cache it, and load the cache
         compiler_options = \
@@ -2464,6 +2920,119 @@ class GenCasadiTest(unittest.TestCase):
 
         casadi_model.simplify(compiler_options)
         
+    def test_iterative_simplification_worklist(self):
+        # Every iteration turns one more variable c<i> into a constant
+        n = 10
+        lines = ["model Cascade", "  Real x(start = 0);"]
+        for i in range(n + 1):
+            lines.append("  Real c{0}, d{0}, e{0};".format(i))
+        lines += ["equation", "  c0 = 1;", "  der(x) = c{0} + e{0};".format(n)]
+        for i in range(1, n + 1):
+            lines.append("  c{} = c{} + 1;".format(i, i - 1))
+        for i in range(n + 1):
+            lines.append("  d{0} = e{0} + c{0};".format(i))
+            lines.append("  e{} = x;".format(i))
+        lines.append("end Cascade;")
+
+        compiler_options = {'eliminate_constant_assignments': True,
+                            'replace_constant_values': True,
+                            'detect_aliases': True,
+                            'iterative_simplification': True,
+                            'simplification_report': True}
+
+        ast_tree = parser.parse("\n".join(lines))
+        casadi_model = gen_casadi.generate(ast_tree, 'Cascade')
+        report = casadi_model.simplify(compiler_options)
+
+        self.assertEqual([v.symbol.name() for v in casadi_model.alg_states], ['d{}'.format(i) for i in range(n + 1)])
+        self.assertEqual(len(casadi_model.equations), n + 2)
+
+        x = casadi_model.states[0].symbol
+        der_x = casadi_model.der_states[0].symbol
+        [eq] = [eq for eq in casadi_model.equations if ca.depends_on(eq, der_x)]
+        f = ca.Function('f', [x, der_x], [eq])
+        self.assertEqual(float(f(1.0, 0.0)), -(n + 2))
+
+        # Only the first iterations visit many equations. After that, only
+        # the equations of the next c<i> and of der(x) are visited.
+        self.assertEqual(report.iterations, n + 2)
+        self.assertEqual(report.passes[0].before['equations'], 3 * n + 4)
+        self.assertTrue(all(p.before['equations'] <= 2 for p in report.passes if p.iteration > 2))
+
+    def test_iterative_simplification_parameters(self):
+        # Every iteration eliminates one more parameter of the chain p3, p2,
+        # p1, p, without changing any of the equations in between.
+        compiler_options = {'replace_parameter_values': True,
+                            'iterative_simplification': True}
+
+        casadi_model = transfer_model(MODEL_DIR, 'SimplifyLoop', compiler_options)
+
+        # Repeat the simplification of all equations until nothing changes
+        ref_model = transfer_model(MODEL_DIR, 'SimplifyLoop', {})
+        ref_options = dict(compiler_options, iterative_simplification=False)
+        while True:
+            state = (len(ref_model.parameters), [str(p.value) for p in ref_model.parameters])
+            ref_model.simplify(ref_options)
+            if state == (len(ref_model.parameters), [str(p.value) for p in ref_model.parameters]):
+                break
+
+        self.assertEqual([(p.symbol.name(), str(p.value)) for p in casadi_model.parameters],
+                         [(p.symbol.name(), str(p.value)) for p in ref_model.parameters])
+        self.assertEqual([str(eq) for eq in casadi_model.equations], [str(eq) for eq in ref_model.equations])
+        self.assertNotIn('p', [p.symbol.name() for p in casadi_model.parameters])
+
+    def test_iterative_simplification_constant_equations(self):
+        # After the first iteration only the constant equation 1 is left
+        compiler_options = {'expand_vectors': True,
+                            'eliminate_constant_assignments': True,
+                            'replace_constant_values': True,
+                            'replace_parameter_values': True,
+                            'detect_aliases': True,
+                            'eliminable_variable_expression': '.*',
+                            'expand_mx': True}
+
+        casadi_model = transfer_model(MODEL_DIR, 'Aircraft', dict(compiler_options, iterative_simplification=True))
+        ref_model = transfer_model(MODEL_DIR, 'Aircraft', compiler_options)
+
+        self.assertEqual([str(eq) for eq in casadi_model.equations], [str(eq) for eq in ref_model.equations])
+        self.assertTrue(all(isinstance(eq, ca.MX) for eq in casadi_model.equations))
+
+    def test_iterative_simplification_vectors(self):
+        # Vectors are only expanded in the first iteration, after which the
+        # aliases are eliminated from the expanded initial equations too.
+        txt = """
+            model IterativeVectors
+                Real x[2], y[2], z[2];
+                parameter Real k = 2;
+            initial equation
+                x = {1, 2};
+                y[1] = 3;
+            equation
+                der(x) = -k * z;
+                z = y;
+                y = x;
+            end IterativeVectors;
+        """
+        ast_tree = parser.parse(txt)
+
+        for compiler_options in [{'expand_vectors': True},
+                                 {'expand_vectors': True, 'detect_aliases': True,
+                                  'replace_parameter_values': True},
+                                 {'expand_vectors': True, 'expand_mx': True, 'detect_aliases': True,
+                                  'eliminable_variable_expression': 'z.*'}]:
+            ref_model = gen_casadi.generate(ast_tree, 'IterativeVectors')
+            ref_model.simplify(compiler_options)
+
+            casadi_model = gen_casadi.generate(ast_tree, 'IterativeVectors')
+            casadi_model.simplify(dict(compiler_options, iterative_simplification=True))
+
+            self.assertEqual([str(eq) for eq in casadi_model.equations], [str(eq) for eq in ref_model.equations])
+            self.assertEqual([str(eq) for eq in casadi_model.initial_equations],
+                             [str(eq) for eq in ref_model.initial_equations])
+            self.assertEqual(len(casadi_model.initial_equations), 3)
+            self.assertEqual([v.symbol.name() for v in casadi_model.alg_states],
+                             [v.symbol.name() for v in ref_model.alg_states])
+
     def test_factor_and_simplify_binary_ops(self):
         # The initial equation is encountered first, and should properly
         # initialize the corresponding symbol for the derivative.
@@ -2517,6 +3086,54 @@ class GenCasadiTest(unittest.TestCase):
             if var.symbol.name() == 'x':
                 self.assertEqual(float(var.value), -27)
 
+    def test_cached_functions(self):
+        casadi_model = transfer_model(MODEL_DIR, 'Spring', {})
+
+        dae_residual_function = casadi_model.dae_residual_function
+        variable_metadata_function = casadi_model.variable_metadata_function
+        self.assertIs(casadi_model.dae_residual_function, dae_residual_function)
+        self.assertIs(casadi_model.variable_metadata_function, variable_metadata_function)
+
+        # Changes to the equations or variables invalidate the functions
+        casadi_model.equations.append(casadi_model.alg_states[0].symbol)
+        self.assertIsNot(casadi_model.dae_residual_function, dae_residual_function)
+        self.assertEqual(casadi_model.dae_residual_function.size1_out(0), len(casadi_model.equations))
+
+        # Also when an equation is replaced in place
+        dae_residual_function = casadi_model.dae_residual_function
+        x = casadi_model.alg_states[0].symbol
+        casadi_model.equations[-1] = x - 2
+        self.assertIsNot(casadi_model.dae_residual_function, dae_residual_function)
+        res = casadi_model.dae_residual_function(*[0] * casadi_model.dae_residual_function.n_in())
+        self.assertEqual(float(res[-1]), -2.0)
+
+        casadi_model.alg_states[0].max = 10.0
+        self.assertIsNot(casadi_model.variable_metadata_function, variable_metadata_function)
+
+        # Changes to the variables of other models do not
+        variable_metadata_function = casadi_model.variable_metadata_function
+        other_model = transfer_model(MODEL_DIR, 'Spring', {})
+        other_model.alg_states[0].max = 10.0
+        self.assertIs(casadi_model.variable_metadata_function, variable_metadata_function)
+
+        variable_metadata_function = casadi_model.variable_metadata_function
+        casadi_model.simplify({'expand_vectors': True})
+        self.assertIsNot(casadi_model.variable_metadata_function, variable_metadata_function)
+
+        # Variables that are added in place are tracked as well
+        z = Variable(ca.MX.sym('z'))
+        casadi_model.alg_states.append(z)
+        variable_metadata_function = casadi_model.variable_metadata_function
+        z.max = 5.0
+        self.assertIsNot(casadi_model.variable_metadata_function, variable_metadata_function)
+
+        # Copies of variables do not belong to the model
+        z_copy = copy.copy(z)
+        self.assertEqual(z_copy.max, 5.0)
+        variable_metadata_function = casadi_model.variable_metadata_function
+        z_copy.max = 6.0
+        self.assertIs(casadi_model.variable_metadata_function, variable_metadata_function)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -6,6 +6,7 @@ from __future__ import print_function, absolute_import, division, print_function
 
 import os
 import sys
+import tempfile
 import time
 import unittest
 import threading
@@ -13,6 +14,7 @@ import threading
 from pymoca import parser
 from pymoca import tree
 from pymoca import ast
+from pymoca import library
 
 MODEL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')
 
@@ -407,6 +409,231 @@ class ParseTest(unittest.TestCase):
                 self.assertIsInstance(flat_tree.classes['A'].symbols['x'].value.values[i].values[j].value, int)
                 self.assertIsInstance(flat_tree.classes['A'].symbols['y'].value.values[i].values[j].value, float)
 
+    def test_tree_walker(self):
+        with open(os.path.join(MODEL_DIR, 'SpringSystem.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='SpringSystem'))
+
+        def count_nodes(node, counts):
+            if isinstance(node, ast.Node):
+                counts[type(node).__name__] = counts.get(type(node).__name__, 0) + 1
+                for k in node.fields():
+                    if k not in ('parent', 'scope'):
+                        count_nodes(getattr(node, k), counts)
+            elif isinstance(node, list):
+                for x in node:
+                    count_nodes(x, counts)
+            elif isinstance(node, dict):
+                for x in node.values():
+                    count_nodes(x, counts)
+            return counts
+
+        class NodeCounter(tree.TreeListener):
+            def __init__(self):
+                super().__init__()
+                self.counts = {}
+
+            def enterEvery(self, node):
+                self.counts[type(node).__name__] = self.counts.get(type(node).__name__, 0) + 1
+
+        counter = NodeCounter()
+        walker = tree.TreeWalker()
+        walker.walk(counter, flat_tree)
+
+        self.assertEqual(counter.counts, count_nodes(flat_tree, {}))
+        self.assertEqual(walker.child_fields(ast.Primary()), ())
+        self.assertNotIn('name', walker.child_fields(ast.Symbol()))
+
+    def test_instance_cache(self):
+        txt = """
+            model Segment
+                parameter Real k = 1.0;
+                Real x;
+            equation
+                der(x) = -k * x;
+            end Segment;
+
+            model Line
+                Segment a;
+                Segment b;
+                Segment c(k = 2.0);
+                Segment d(k = 2.0);
+            end Line;
+            """
+        ast_tree = parser.parse(txt)
+        line = ast_tree.classes['Line']
+
+        instance_cache = {}
+        instance_tree = tree.build_instance_tree(line, parent=ast_tree, instance_cache=instance_cache)
+        self.assertEqual(len(instance_cache), 2)
+
+        # Instances are copies, and can be modified independently
+        types = [instance_tree.symbols[x].type for x in 'abcd']
+        self.assertEqual(len(set(map(id, types))), 4)
+        self.assertIs(types[0].equations[0], types[1].equations[0])
+
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='Line'))
+        symbols = flat_tree.classes['Line'].symbols
+        self.assertEqual(symbols['a.k'].value.value, 1.0)
+        self.assertEqual(symbols['b.k'].value.value, 1.0)
+        self.assertEqual(symbols['c.k'].value.value, 2.0)
+        self.assertEqual(symbols['d.k'].value.value, 2.0)
+        self.assertEqual(len(flat_tree.classes['Line'].equations), 4)
+
+    def test_flattening_session(self):
+        txt = """
+            package P
+                connector Port
+                    Real p;
+                    flow Real q;
+                end Port;
+
+                model Segment
+                    parameter Real k = 1.0;
+                    Real x;
+                    Port port;
+                equation
+                    der(x) = -k * x + port.q;
+                    port.p = x;
+                end Segment;
+
+                model Source
+                    Real y;
+                    Port port;
+                equation
+                    y = 1.0;
+                    port.p = y;
+                end Source;
+
+                model Line
+                    Segment a;
+                    Segment b(k = 2.0);
+                    Source s;
+                equation
+                    connect(s.port, a.port);
+                    connect(a.port, b.port);
+                end Line;
+            end P;
+            """
+        edited_txt = """
+            within P;
+            model Source
+                Real y;
+                Port port;
+            equation
+                y = 2.0;
+                port.p = y;
+            end Source;
+            """
+        class_name = ast.ComponentRef.from_string('P.Line')
+
+        ast_tree = parser.parse(txt)
+        session = tree.FlatteningSession(ast_tree, class_name)
+        self.assertEqual(repr(session.flatten()), repr(tree.flatten(parser.parse(txt), class_name)))
+
+        cached_a = session._component_cache['a']
+        cached_s = session._component_cache['s']
+        session.update(parser.parse(edited_txt))
+        self.assertIs(session._component_cache['a'], cached_a)
+        self.assertNotIn('s', session._component_cache)
+
+        ref_tree = parser.parse(txt)
+        ref_tree.extend(parser.parse(edited_txt), replace=True)
+        self.assertEqual(repr(session.flatten()), repr(tree.flatten(ref_tree, class_name)))
+        self.assertIsNot(session._component_cache['s'], cached_s)
+
+        # Replacing a class that all components depend on flattens all of them again
+        session.update(parser.parse("within P; connector Port Real p; flow Real q; end Port;"))
+        self.assertEqual(session._component_cache, {})
+
+    def test_connection_sets(self):
+        sets = tree.ConnectionSets()
+        sets.connect('a', 1, 'b', 2)
+        sets.connect('c', 3, 'd', 4)
+        sets.connect('e', 5, 'c', 6)
+        sets.connect('b', 7, 'c', 8)
+        sets.connect('f', 9, 'g', 10)
+
+        # Members of the left set come first, then those of the right set,
+        # and then the newly connected variables.
+        self.assertEqual(list(sets), [[1, 7, 8, 4, 5], [9, 10]])
+        self.assertEqual(sets.find('a'), sets.find('e'))
+        self.assertNotEqual(sets.find('a'), sets.find('f'))
+
+    def test_parse_cache(self):
+        file_name = os.path.join(MODEL_DIR, 'Aircraft.mo')
+        ref_tree = parser.parse_file(file_name)
+
+        with tempfile.TemporaryDirectory() as cache_folder:
+            ast_tree = parser.parse_file(file_name, cache_folder)
+            cache_files = os.listdir(cache_folder)
+            self.assertEqual(len(cache_files), 1)
+
+            # Second parse is loaded from the cache
+            cached_tree = parser.parse_file(file_name, cache_folder)
+            self.assertEqual(os.listdir(cache_folder), cache_files)
+
+            self.assertEqual(repr(ref_tree), repr(ast_tree))
+            self.assertEqual(repr(ref_tree), repr(cached_tree))
+
+            flat_tree = tree.flatten(cached_tree, ast.ComponentRef(name='Aircraft'))
+            self.assertIn('Aircraft', flat_tree.classes)
+
+    def test_parse_files_parallel(self):
+        file_names = [os.path.join(MODEL_DIR, f) for f in ['Aircraft.mo', 'Spring.mo', 'Inheritance.mo']]
+
+        serial_tree = parser.parse_files(file_names)
+        parallel_tree = parser.parse_files(file_names, workers=2)
+
+        self.assertEqual(list(serial_tree.classes.keys()), list(parallel_tree.classes.keys()))
+        self.assertEqual(repr(serial_tree), repr(parallel_tree))
+
+    def test_sll_parse(self):
+        for f in sorted(os.listdir(MODEL_DIR)):
+            if not f.endswith('.mo'):
+                continue
+            with open(os.path.join(MODEL_DIR, f), 'r') as f:
+                txt = f.read()
+            self.assertEqual(repr(parser.parse(txt, sll=False)), repr(parser.parse(txt, sll=True)))
+
+    def test_parse_without_parse_tree(self):
+        for f in sorted(os.listdir(MODEL_DIR)):
+            if not f.endswith('.mo'):
+                continue
+            with open(os.path.join(MODEL_DIR, f), 'r') as f:
+                txt = f.read()
+            self.assertEqual(repr(parser.parse(txt)), repr(parser.parse(txt, build_parse_tree=False)))
+
+    def test_scan_file(self):
+        with open(os.path.join(MODEL_DIR, 'TreeLookup.mo'), 'r') as f:
+            within, names = library.scan_file(f.read())
+        self.assertEqual(within, ('Level1', 'Level2', 'Level3'))
+        self.assertEqual(names, ['TestPackage', 'PackageComponents', 'Test'])
+
+        within, names = library.scan_file('within A.B; // model C\n'
+                                          'package D "end E;" type T = Real; model F end F; end D;')
+        self.assertEqual(within, ('A', 'B'))
+        self.assertEqual(names, ['D'])
+
+    def test_lazy_loading(self):
+        file_names = []
+        for root, dir, files in os.walk(MODEL_DIR, followlinks=True):
+            for item in files:
+                if item.endswith('.mo'):
+                    file_names.append(os.path.join(root, item))
+
+        eager_tree = parser.parse_files(file_names)
+        eager_class = tree.flatten(eager_tree, ast.ComponentRef(name='Aircraft'))
+
+        loader = library.LibraryLoader(file_names)
+        lazy_tree = loader.create_tree()
+        self.assertEqual(loader.loaded_files, [])
+
+        lazy_class = tree.flatten(lazy_tree, ast.ComponentRef(name='Aircraft'))
+        self.assertEqual(loader.loaded_files, [os.path.join(MODEL_DIR, 'Aircraft.mo')])
+        self.assertEqual(repr(eager_class), repr(lazy_class))
+
 
 if __name__ == "__main__":
     unittest.main()
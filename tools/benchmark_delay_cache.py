@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Delay cache benchmark tool. Scales the DelayForLoop test model to a large
+number of delayed channels, and reports how long it takes to compile and
+save the model to cache, and to load it from cache again.
+"""
+
+from optparse import OptionParser
+import os
+import shutil
+import tempfile
+import timeit
+
+# Parse command line arguments
+usage = "usage: %prog [options] [N_DELAYS ...]"
+parser = OptionParser(usage)
+parser.add_option("-n", "--number", dest="number", type="int", default=3,
+                  help="Number of times to load each model, of which the fastest is reported")
+(options, args) = parser.parse_args()
+
+try:
+    sizes = [int(x) for x in args] if args else [100, 1000, 5000]
+except ValueError:
+    parser.error("number of delays must be an integer")
+
+model_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'test', 'models', 'DelayForLoop.mo')
+with open(model_file, 'r') as f:
+    text = f.read()
+
+# Import rest of pymoca
+from pymoca.backends.casadi.api import CachedModel, transfer_model
+
+# Every element of the vector delay becomes a delay of its own
+compiler_options = {'cache': True, 'expand_vectors': True}
+
+print("{:>10} {:>10} {:>10}".format("Delays", "Save [s]", "Load [s]"))
+
+for n in sizes:
+    # DelayForLoop has a delay for all but the first element
+    scaled_text = text.replace('[3]', '[{}]'.format(n + 1)).replace('2:3', '2:{}'.format(n + 1))
+
+    model_folder = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(model_folder, 'DelayForLoop.mo'), 'w') as f:
+            f.write(scaled_text)
+
+        t_save = timeit.timeit(lambda: transfer_model(model_folder, 'DelayForLoop', compiler_options), number=1)
+
+        model = transfer_model(model_folder, 'DelayForLoop', compiler_options)
+        assert isinstance(model, CachedModel)
+        assert len(model.delay_arguments) == n
+
+        t_load = min(timeit.repeat(lambda: transfer_model(model_folder, 'DelayForLoop', compiler_options),
+                                   number=1, repeat=options.number))
+    finally:
+        shutil.rmtree(model_folder)
+
+    print("{:>10} {:>10.4f} {:>10.4f}".format(n, t_save, t_load))
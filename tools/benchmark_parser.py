@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Parser benchmark tool. Compares parsing with full LL prediction to parsing
+with SLL prediction first (and LL as fallback).
+"""
+
+from optparse import OptionParser
+import os
+import fnmatch
+import sys
+import timeit
+
+# Parse command line arguments
+usage = "usage: %prog [options] [MODEL_FOLDER]"
+parser = OptionParser(usage)
+parser.add_option("-n", "--number", dest="number", type="int", default=3,
+                  help="Number of times to parse each file, of which the fastest is reported")
+(options, args) = parser.parse_args()
+if len(args) > 1:
+    parser.error("incorrect number of arguments")
+
+if args:
+    model_folder = args[0]
+else:
+    model_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'test', 'models')
+
+# Import rest of pymoca
+from pymoca import parser
+
+file_names = []
+for root, dir, files in os.walk(model_folder, followlinks=True):
+    for item in fnmatch.filter(files, "*.mo"):
+        file_names.append(os.path.join(root, item))
+
+print("{:<40} {:>10} {:>10} {:>8}".format("File", "LL [s]", "SLL [s]", "Speedup"))
+
+total_ll = 0.0
+total_sll = 0.0
+for file_name in sorted(file_names):
+    with open(file_name, 'r') as f:
+        text = f.read()
+
+    if repr(parser.parse(text, sll=False)) != repr(parser.parse(text, sll=True)):
+        sys.exit("Parse result of {} differs between LL and SLL".format(file_name))
+
+    t_ll = min(timeit.repeat(lambda: parser.parse(text, sll=False), number=1, repeat=options.number))
+    t_sll = min(timeit.repeat(lambda: parser.parse(text, sll=True), number=1, repeat=options.number))
+    total_ll += t_ll
+    total_sll += t_sll
+
+    print("{:<40} {:>10.4f} {:>10.4f} {:>7.2f}x".format(os.path.basename(file_name), t_ll, t_sll, t_ll / t_sll))
+
+print("{:<40} {:>10.4f} {:>10.4f} {:>7.2f}x".format("Total", total_ll, total_sll, total_ll / total_sll))
@@ -18,6 +18,9 @@ parser.add_option("-c", "--casadi", dest="casadi_folder",
                   help="CasADi installation folder")
 parser.add_option("-f", "--flatten_only",
                   action="store_true", dest="flatten_only")
+parser.add_option("-l", "--lazy",
+                  action="store_true", dest="lazy",
+                  help="Only parse the files of the classes the model depends on")
 parser.add_option("-v", "--verbose",
                   action="store_true", dest="verbose")
 (options, args) = parser.parse_args()
@@ -32,20 +35,24 @@ logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO)
 
 # Import rest of pymoca
 from pymoca import parser, tree, ast
+from pymoca.library import LibraryLoader
 
 # Compile
 if options.flatten_only:
     # Load folder
-    _ast = None
-    for root, dir, files in os.walk(model_folder, followlinks=True):
-        for item in fnmatch.filter(files, "*.mo"):
-            logger.info("Parsing {}".format(item))
+    if options.lazy:
+        _ast = LibraryLoader.from_folders([model_folder]).create_tree()
+    else:
+        _ast = None
+        for root, dir, files in os.walk(model_folder, followlinks=True):
+            for item in fnmatch.filter(files, "*.mo"):
+                logger.info("Parsing {}".format(item))
 
-            with open(os.path.join(root, item), 'r') as f:
-                if _ast is None:
-                    _ast = parser.parse(f.read())
-                else:
-                    _ast.extend(parser.parse(f.read()))
+                with open(os.path.join(root, item), 'r') as f:
+                    if _ast is None:
+                        _ast = parser.parse(f.read())
+                    else:
+                        _ast.extend(parser.parse(f.read()))
 
     logger.info("Flattening")
 
@@ -67,6 +74,7 @@ else:
          'eliminable_variable_expression': r'_\w+',
          'detect_aliases': True,
          'expand': False,
+         'lazy_loading': bool(options.lazy),
          'cache': True}
 
     model = transfer_model(model_folder, model_name, compiler_options)